@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+"""boot_progress.py
+
+Tracks the progress of a pragma_boot launch by parsing its pragma_boot.log
+incrementally.  The byte offset parsed up to and a small summary of the
+launch (phase, percent done, frontend name, nodes booted) are saved next to
+the log in pragma_boot.log.progress, so each poll only reads and parses the
+bytes appended since the last one, however big the log has grown.
+
+The milestones and percentages are those web/scanlog.php has always shown:
+preparing images (1%), configuring the network (16%), booting the frontend
+(18%), booting each compute node (an even share of the remaining 82%) and
+completion (100%).  The time each phase is first reached is kept too, and
+from it how long preparing the image took.
+
+pcc-check-reservations.py feeds it the bytes it fetches from the remote log;
+run as a script it tracks a local log and prints the summary as JSON.
+
+Example:
+      $ boot_progress.py /tmp/1234.0/pragma_boot.log
+      {"phase": "booting", "percent": 59, "description": "Booting ...", ...}
+"""
+
+import calendar
+import json
+import os
+import re
+import sys
+import time
+
+# file, next to the log, that the parse state of the log is saved in
+STATE_SUFFIX = ".progress"
+
+FIX_IMAGES_RE = re.compile(r"fix_images")
+ALLOCATE_RE = re.compile(r"kvm_rocks/allocate")
+NUM_NODES_RE = re.compile(r"numnodes=\D*(\d+)")
+FE_NAME_RE = re.compile(r"fe-name=(\S+)")
+FRONTEND_RE = re.compile(
+  r"(?:Allocated cluster|Successfully deployed frontend) (\S+)")
+BOOT_RE = re.compile(r"Executing.*kvm_rocks/boot")
+QUOTED_RE = re.compile(r"'([^']+)'")
+COMPLETE_RE = re.compile(r"pragma_boot complete")
+TIMESTAMP_RE = re.compile(r"^\D{0,4}(\d{4}-\d\d-\d\d)[ T](\d\d:\d\d:\d\d)")
+
+
+class BootProgress:
+  # summary fields and their values before anything is parsed
+  FIELDS = {"phase": "waiting", "percent": 0, "description": "",
+            "frontend": None, "num_nodes": 0, "nodes_booted": 0,
+            "complete": False, "phase_times": {}, "prepare_secs": None}
+
+  def __init__(self, log_path, state=None):
+    self.log_path = log_path
+    self.offset = 0
+    self.partial = ""
+    self.summary = dict(BootProgress.FIELDS)
+    self.summary["phase_times"] = {}
+    if state:
+      self.offset = state["offset"]
+      self.partial = state["partial"]
+      self.summary.update(state["summary"])
+
+  @classmethod
+  def load(cls, log_path):
+    """Return the progress of log_path saved by the last poll, if any"""
+    try:
+      f = open(log_path + STATE_SUFFIX)
+      try:
+        return BootProgress(log_path, json.load(f))
+      finally:
+        f.close()
+    except (IOError, ValueError, KeyError):
+      return BootProgress(log_path)
+
+  def save(self):
+    tmp_path = "%s%s.%d" % (self.log_path, STATE_SUFFIX, os.getpid())
+    f = open(tmp_path, "w")
+    json.dump({"offset": self.offset, "partial": self.partial,
+               "summary": self.summary}, f)
+    f.close()
+    os.rename(tmp_path, self.log_path + STATE_SUFFIX)
+
+  def reset(self):
+    """Forget everything parsed, e.g. when the log has been replaced"""
+    self.__init__(self.log_path)
+
+  def feed(self, data):
+    """Parse the next bytes of the log"""
+    self.offset += len(data)
+    lines = (self.partial + data).split("\n")
+    self.partial = lines.pop()
+    for line in lines:
+      self.parse(line)
+
+  def parse(self, line):
+    summary = self.summary
+    phase = summary["phase"]
+    if FIX_IMAGES_RE.search(line):
+      summary.update(phase="preparing", percent=1,
+                     description="Preparing images...")
+    elif ALLOCATE_RE.search(line):
+      summary.update(phase="configuring", percent=16,
+                     description="Configuring network...")
+    elif NUM_NODES_RE.search(line):
+      summary["num_nodes"] = int(NUM_NODES_RE.search(line).group(1))
+    elif FE_NAME_RE.search(line):
+      summary["frontend"] = FE_NAME_RE.search(line).group(1)
+    elif BOOT_RE.search(line):
+      if summary["nodes_booted"] == 0:
+        summary["percent"] = 18
+      else:
+        summary["percent"] = min(99, summary["percent"] +
+                                 82.0 / (summary["num_nodes"] + 1))
+      summary["nodes_booted"] += 1
+      names = QUOTED_RE.findall(line)
+      summary.update(phase="booting", description="Booting %s..." % (
+        names[2] if len(names) > 2 else "node"))
+    elif COMPLETE_RE.search(line):
+      summary.update(phase="complete", percent=100, complete=True,
+                     description="Completed boot of %s" % summary["frontend"])
+    matched = FRONTEND_RE.search(line)
+    if matched:
+      summary["frontend"] = matched.group(1)
+    if summary["phase"] != phase:
+      self.reached(summary["phase"], line)
+
+  def reached(self, phase, line):
+    """Note when a phase was first reached, from the timestamp that starts
+    the log line if it has one and otherwise from when it was parsed"""
+    times = self.summary["phase_times"]
+    if phase in times:
+      return
+    matched = TIMESTAMP_RE.match(line)
+    try:
+      times[phase] = calendar.timegm(time.strptime(
+        "%s %s" % matched.groups(), "%Y-%m-%d %H:%M:%S"))
+    except (AttributeError, ValueError):
+      times[phase] = time.time()
+    # image preparation lasts from fix_images until the network is configured
+    if phase == "configuring" and "preparing" in times:
+      self.summary["prepare_secs"] = times["configuring"] - times["preparing"]
+
+  def update(self):
+    """Parse whatever has been appended to the local log since the last
+    poll, starting over if the log has been replaced by a shorter one"""
+    try:
+      size = os.path.getsize(self.log_path)
+    except OSError:
+      return
+    if size < self.offset:
+      self.reset()
+    if size == self.offset:
+      return
+    f = open(self.log_path, "rb")
+    try:
+      f.seek(self.offset)
+      self.feed(f.read(size - self.offset))
+    finally:
+      f.close()
+
+  def as_dict(self):
+    """Return the summary with the percent rounded for display"""
+    summary = dict(self.summary)
+    summary["percent"] = int(summary["percent"])
+    return summary
+
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  if len(argv) != 1:
+    sys.stderr.write("Usage: boot_progress.py {pragma_boot.log}\n")
+    return 1
+  progress = BootProgress.load(argv[0])
+  progress.update()
+  try:
+    progress.save()
+  except (IOError, OSError):
+    pass  # e.g. log dir not writable; parse from the start next time
+  print json.dumps(progress.as_dict())
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
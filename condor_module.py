@@ -4,60 +4,473 @@ Created on Mar 01, 2014
 @author: yuanluo
 '''
 
+import fcntl
 import json
+import os
 import subprocess
 import re
+import shutil
+import sys
+import threading
+import time
 
 condor_bin='/opt/condor/bin'
 
+# condor_status and condor_q JSON output is cached here and reused until it is
+# older than the max age (secs) of its query
+snapshot_dir='/var/run/condor_module'
+SNAPSHOT_MAX_AGE = {"condor_status": 30, "condor_q": 10}
+
+# htcondor Python bindings are used for queries when installed; they are
+# imported on first use and set to False if unavailable
+htcondor = None
+# max number of condor_* processes this process runs at the same time
+subprocess_slots = threading.BoundedSemaphore(4)
+
 def printTest(name):
      print 'Hello', name
 
-def condorCLI(args,format):
+def condorCLI(args,format,**kwargs):
     if args[0] == "condor_status":
-        condor_status(format)
+        condor_status(format, **kwargs)
     if args[0] == "condor_q":
-        condor_q(format)
+        condor_q(format, **kwargs)
     if args[0] == "condor_history":
-        condor_history(format)
+        condor_history(format, **kwargs)
     if args[0] == "condor_submit":
-        condor_submit(args,format)
-def condor_status(format):
-    p = subprocess.Popen([condor_bin+"/condor_status","-wide"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    images = __text2dict__( out, filter="slot", columns = ["Name", "OpSys", "Arch", "State", "Activity", "LoadAv", "Mem","ActivityTime"]   )
+        if len(args) > 2:
+            condor_submit_bulk_cli(args[1:],format)
+        else:
+            condor_submit(args,format)
+    if args[0] == "refresh_snapshots":
+        refresh_snapshots()
+def condor_status(format, max_age=None, out=None):
     if format=="json":
-        print json.dumps( images )
+        __print_snapshot__( "condor_status", iter_status, max_age, out )
     else:
-        print out
+        __print_text__( [condor_bin+"/condor_status","-wide"], out )
 
-def condor_q(format):
-    p = subprocess.Popen([condor_bin+"/condor_q","-wide"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    images = __text2dict__( out, filter="/", columns = ["ID", "OWNER", "SUBMITTED", "RUN_TIME", "ST", "PRI", "SIZE","CMD"]   )
+def condor_q(format, max_age=None, out=None):
     if format=="json":
-        print json.dumps( images )
+        __print_snapshot__( "condor_q", iter_queue, max_age, out )
     else:
-        print out
-        
-def condor_history(format):
-    p = subprocess.Popen([condor_bin+"/condor_history","-wide"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    images = __text2dict__( out, filter="/", columns = ["ID", "OWNER", "SUBMITTED", "RUN_TIME", "COMPLETED","CMD"]   )
+        __print_text__( [condor_bin+"/condor_q","-wide"], out )
+
+def refresh_snapshots():
+    """Re-run every cached query now, e.g. from a single cron refresher"""
+    for query, func in [("condor_status", iter_status), ("condor_q", iter_queue)]:
+        snapshot( query, func, 0 ).close()
+
+def snapshot(query, func, max_age=None):
+    """Return an open file holding the JSON records of a cached query
+
+    The snapshot is reused if it is younger than max_age secs (default from
+    SNAPSHOT_MAX_AGE).  Otherwise the first caller takes an exclusive lock and
+    reruns the query while concurrent callers block on the lock and then
+    read the snapshot it wrote, so only one condor_* process runs at a time.
+
+    Args:
+      query(string): name of the query, e.g. "condor_status"
+      func(function): generator of (key, record) pairs for the query
+      max_age(int): max age in secs of a usable snapshot; 0 to always refresh
+    """
+    if max_age is None:
+        max_age = SNAPSHOT_MAX_AGE.get( query, 0 )
+    path = os.path.join( snapshot_dir, query + ".json" )
+    f = __open_fresh__( path, max_age )
+    if f:
+        return f
+    if not os.path.isdir( snapshot_dir ):
+        os.makedirs( snapshot_dir )
+    started = time.time()
+    lock = open( path + ".lock", "a" )
+    try:
+        fcntl.flock( lock, fcntl.LOCK_EX )
+        # another caller may have refreshed it while we waited for the lock
+        if os.path.exists( path ) and os.path.getmtime( path ) >= started:
+            return open( path )
+        tmp_path = "%s.%d" % (path, os.getpid())
+        tmp = open( tmp_path, "w" )
+        __print_json_stream__( func(), tmp )
+        tmp.close()
+        os.rename( tmp_path, path )
+        return open( path )
+    finally:
+        fcntl.flock( lock, fcntl.LOCK_UN )
+        lock.close()
+
+def __open_fresh__( path, max_age ):
+    try:
+        if max_age > 0 and time.time() - os.path.getmtime( path ) < max_age:
+            return open( path )
+    except (IOError, OSError):
+        pass
+    return None
+
+def __print_snapshot__( query, func, max_age, out=None ):
+    out = out or sys.stdout
+    try:
+        f = snapshot( query, func, max_age )
+    except (IOError, OSError):
+        # no usable snapshot dir (e.g. not writable); query directly
+        __print_json_stream__( func(), out )
+        return
+    # copied in fixed-size chunks, as the snapshot may be one long line
+    try:
+        shutil.copyfileobj( f, out )
+    finally:
+        f.close()
+
+def condor_history(format, constraint=None, attributes=None, limit=None,
+                   since=None, until=None, out=None):
+    """Print job history, newest first, one JSON record per line
+
+    constraint, limit and the since/until window on CompletionDate are passed
+    down to condor_history so only matching jobs are read.  With attributes
+    each record holds just those ClassAd attributes instead of the -wide
+    columns.  Each line is {ID: record}, so merging all lines gives the same
+    object that condor_q and condor_status print.
+    """
+    out = out or sys.stdout
     if format=="json":
-        print json.dumps( images )
+        for key, value in iter_history( constraint, attributes, limit, since, until ):
+            out.write( json.dumps( {key: value} ) + "\n" )
+            out.flush()
     else:
-        print out
+        args = []
+        constraint = __history_constraint__( constraint, since, until )
+        if constraint:
+            args += ["-constraint", constraint]
+        if limit is not None:
+            args += ["-limit", str(int(limit))]
+        __print_text__( [condor_bin+"/condor_history","-wide"] + args, out )
+
+STATUS_ATTRS = ["Name", "OpSys", "Arch", "State", "Activity", "LoadAvg",
+                "Memory", "EnteredCurrentActivity", "MyCurrentTime"]
+QUEUE_ATTRS = ["ClusterId", "ProcId", "Owner", "QDate", "RemoteWallClockTime",
+               "JobCurrentStartDate", "JobStatus", "JobPrio", "ImageSize",
+               "Cmd", "Args", "ServerTime"]
+HISTORY_ATTRS = ["ClusterId", "ProcId", "Owner", "QDate",
+                 "RemoteWallClockTime", "CompletionDate", "Cmd", "Args"]
+SLOT_ATTRS = ["Name", "Machine", "State", "Cpus", "Memory"]
+JOB_STATUS = {1: "I", 2: "R", 3: "X", 4: "C", 5: "H", 6: ">", 7: "S"}
 
-def condor_submit(args, format):
-    p = subprocess.Popen([condor_bin+"/condor_submit",args[1]], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    images = __text2dict__( out, filter="submitted", columns = ["number_of_jobs", "", "", "", "","cluster"]   )
+def iter_status():
+    """Yield (Name, record) for each slot, in the -wide column layout"""
+    for ad in __iter_query__( "condor_status", STATUS_ATTRS ):
+        now = ad.get("MyCurrentTime", time.time())
+        yield ad.get("Name"), {
+            "OpSys": ad.get("OpSys"),
+            "Arch": ad.get("Arch"),
+            "State": ad.get("State"),
+            "Activity": ad.get("Activity"),
+            "LoadAv": "%.3f" % ad.get("LoadAvg", 0),
+            "Mem": str(ad.get("Memory")),
+            "ActivityTime": __duration__( now - ad.get("EnteredCurrentActivity", now) ) }
+
+def iter_queue():
+    """Yield (ID, record) for each job in the queue, in the -wide column layout"""
+    for ad in __iter_query__( "condor_q", QUEUE_ATTRS ):
+        run_time = ad.get("RemoteWallClockTime", 0)
+        if ad.get("JobStatus") == 2 and "JobCurrentStartDate" in ad:
+            run_time += ad.get("ServerTime", time.time()) - ad["JobCurrentStartDate"]
+        yield __job_id__(ad), {
+            "OWNER": ad.get("Owner"),
+            "SUBMITTED": __date__( ad.get("QDate") ),
+            "RUN_TIME": __duration__( run_time ),
+            "ST": JOB_STATUS.get( ad.get("JobStatus"), "?" ),
+            "PRI": str(ad.get("JobPrio", 0)),
+            "SIZE": "%.1f" % (ad.get("ImageSize", 0) / 1024.0),
+            "CMD": __command__(ad) }
+
+def iter_slots(machine=None):
+    """Yield (Name, record) for each slot, optionally only those of machine,
+    with the State, Cpus and Memory (MB) used to plan placements"""
+    constraint = None
+    if machine:
+        constraint = 'Machine == %s' % json.dumps( machine )
+    for ad in __iter_query__( "condor_status", SLOT_ATTRS, constraint ):
+        yield ad.get("Name"), {
+            "Machine": ad.get("Machine"),
+            "State": ad.get("State"),
+            "Cpus": int(ad.get("Cpus", 0)),
+            "Memory": int(ad.get("Memory", 0)) }
+
+def iter_images(machine=None):
+    """Yield (Machine, images) for each machine advertising the VC images
+    staged in its pragma_boot repository (ROCKS_VC_IMAGES from rocks_ad.sh)"""
+    constraint = "ROCKS_VC_IMAGES =!= undefined"
+    if machine:
+        constraint += ' && Machine == %s' % json.dumps( machine )
+    seen = set()
+    for ad in __iter_query__( "condor_status", ["Machine", "ROCKS_VC_IMAGES"], constraint ):
+        if ad.get("Machine") in seen:
+            continue
+        seen.add( ad.get("Machine") )
+        yield ad.get("Machine"), [image.strip() for image in
+                                  str(ad.get("ROCKS_VC_IMAGES") or "").split(",")
+                                  if image.strip()]
+
+def iter_history(constraint=None, attributes=None, limit=None, since=None,
+                 until=None):
+    """Yield (ID, record) for each completed job matching the arguments
+
+    Args:
+      constraint(string): ClassAd expression jobs must match
+      attributes(list): attributes to return instead of the -wide columns
+      limit(int): max number of jobs to return
+      since(int): only jobs completed at or after this time (secs since epoch)
+      until(int): only jobs completed at or before this time
+    """
+    constraint = __history_constraint__( constraint, since, until )
+    if attributes:
+        for ad in __iter_query__( "condor_history",
+                                  ["ClusterId", "ProcId"] + list(attributes),
+                                  constraint, limit ):
+            yield __job_id__(ad), dict( [(attr, ad.get(attr)) for attr in attributes] )
+        return
+    for ad in __iter_query__( "condor_history", HISTORY_ATTRS, constraint, limit ):
+        yield __job_id__(ad), {
+            "OWNER": ad.get("Owner"),
+            "SUBMITTED": __date__( ad.get("QDate") ),
+            "RUN_TIME": __duration__( ad.get("RemoteWallClockTime", 0) ),
+            "COMPLETED": __date__( ad.get("CompletionDate") ),
+            "CMD": __command__(ad) }
+
+def condor_submit(args, format, out=None):
+    out = out or sys.stdout
+    with subprocess_slots:
+        p = subprocess.Popen([condor_bin+"/condor_submit",args[1]], stdout=subprocess.PIPE)
+        text, err = p.communicate()
+    images = __text2dict__( text, filter="submitted", columns = ["number_of_jobs", "", "", "", "","cluster"]   )
     if format=="json":
-        print json.dumps( images )
+        out.write( json.dumps( images ) + "\n" )
     else:
-        print out
+        out.write( text + "\n" )
     
+QUEUE_RE = re.compile( r'^\s*queue\b\s*(\d*)', re.IGNORECASE | re.MULTILINE )
+INITIALDIR_RE = re.compile( r'^\s*initialdir\s*=', re.IGNORECASE | re.MULTILINE )
+TERSE_RE = re.compile( r'^(\d+)\.(\d+)\s*-\s*(\d+)\.(\d+)\s*$', re.MULTILINE )
+
+def condor_submit_bulk_cli(files, format, out=None):
+    out = out or sys.stdout
+    results = condor_submit_bulk(files)
+    if format=="json":
+        out.write( json.dumps( results ) + "\n" )
+    else:
+        for result in results:
+            if result["error"]:
+                out.write( "%s: ERROR %s\n" % (result["file"], result["error"]) )
+            else:
+                out.write( "%s: %s\n" % (result["file"], " ".join(
+                    ["%s.%s" % (result["cluster"], proc) for proc in result["procs"]] )) )
+
+def condor_submit_bulk(files):
+    """Submit many submit description files in one condor_submit call
+
+    The files are joined into one multi-queue submit description, each part
+    given its own initialdir so relative paths still resolve, and submitted
+    as a single schedd transaction.  If that fails, the files are submitted
+    one at a time so one bad file does not stop the others.  Note that
+    submit commands carry over from one part to the next, so each file
+    should set every command it relies on (as the vc<id>.sub files do).
+
+    Args:
+      files(list): paths of submit description files
+
+    Returns:
+      list: one dict per file, in order, with keys file, cluster, procs
+        (list of proc IDs) and error (None if the jobs were queued)
+    """
+    results = []
+    parts = []
+    for path in files:
+        result = {"file": path, "cluster": None, "procs": [], "error": None}
+        results.append(result)
+        try:
+            f = open(path)
+            text = f.read()
+            f.close()
+        except IOError, e:
+            result["error"] = str(e)
+            continue
+        counts = [int(n or 1) for n in QUEUE_RE.findall(text)]
+        if not counts:
+            result["error"] = "no queue statement"
+            continue
+        if not INITIALDIR_RE.search(text):
+            text = "initialdir = %s\n%s" % (os.path.dirname(os.path.abspath(path)), text)
+        parts.append( (result, text, sum(counts)) )
+    if not parts:
+        return results
+
+    (code, text, err) = __submit_terse__( "\n".join([part[1] for part in parts]) )
+    if code == 0:
+        jobs = __terse_jobs__( text )
+        for (result, part_text, count) in parts:
+            for (cluster, proc) in jobs[:count]:
+                result["cluster"] = cluster
+                result["procs"].append(proc)
+            jobs = jobs[count:]
+        return results
+
+    # isolate the failing descriptions
+    for (result, part_text, count) in parts:
+        (code, text, err) = __submit_terse__( part_text )
+        if code == 0:
+            jobs = __terse_jobs__( text )
+            result["cluster"] = jobs[0][0] if jobs else None
+            result["procs"] = [proc for (cluster, proc) in jobs]
+        else:
+            result["error"] = (err or text).strip()
+    return results
+
+def __submit_terse__( description ):
+    """Run condor_submit -terse on a submit description read from stdin"""
+    with subprocess_slots:
+        p = subprocess.Popen([condor_bin+"/condor_submit", "-terse", "-"],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate( description )
+    return (p.returncode, out, err)
+
+def __terse_jobs__( text ):
+    """Expand condor_submit -terse ranges into a list of (cluster, proc)"""
+    jobs = []
+    for (cluster, first, last_cluster, last) in TERSE_RE.findall( text ):
+        for proc in range( int(first), int(last) + 1 ):
+            jobs.append( (int(cluster), proc) )
+    return jobs
+
+def __print_text__( cmd, out=None ):
+    out = out or sys.stdout
+    with subprocess_slots:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        for line in p.stdout:
+            out.write(line)
+        p.wait()
+
+def __print_json_stream__( pairs, out=None ):
+    """Print (key, value) pairs as one JSON object without holding them all"""
+    out = out or sys.stdout
+    sep = "{"
+    for key, value in pairs:
+        out.write( "%s%s: %s" % (sep, json.dumps(key), json.dumps(value)) )
+        sep = ", "
+    out.write( "}\n" if sep == ", " else "{}\n" )
+
+def __history_constraint__( constraint, since, until ):
+    """Combine a constraint and a CompletionDate window into one expression"""
+    clauses = []
+    if constraint:
+        clauses.append( "(%s)" % constraint )
+    if since is not None:
+        clauses.append( "CompletionDate >= %d" % int(since) )
+    if until is not None:
+        clauses.append( "CompletionDate <= %d" % int(until) )
+    return " && ".join(clauses) or None
+
+def __bindings__():
+    global htcondor
+    if htcondor is None:
+        try:
+            import htcondor as bindings
+            htcondor = bindings
+        except ImportError:
+            htcondor = False
+    return htcondor
+
+def __iter_query__( tool, attrs, constraint=None, limit=None ):
+    """Yield one dict per ClassAd returned by a condor_status, condor_q or
+    condor_history query, using the htcondor bindings if installed and
+    otherwise the tool's -long output"""
+    bindings = __bindings__()
+    if bindings:
+        if tool == "condor_status":
+            ads = bindings.Collector().query( bindings.AdTypes.Startd,
+                                              constraint or "true", attrs )
+        elif tool == "condor_q":
+            ads = bindings.Schedd().xquery( constraint or "true", attrs )
+        else:
+            ads = bindings.Schedd().history( constraint or "true", attrs,
+                                             -1 if limit is None else int(limit) )
+        for ad in ads:
+            yield __ad2dict__( ad )
+        return
+
+    args = []
+    if constraint:
+        args += ["-constraint", constraint]
+    if limit is not None:
+        args += ["-limit", str(int(limit))]
+    with subprocess_slots:
+        p = subprocess.Popen([condor_bin+"/"+tool, "-long", "-attributes", ",".join(attrs)] + args,
+                             stdout=subprocess.PIPE)
+        for ad in __iter_classads__( p.stdout ):
+            yield ad
+        p.stdout.close()
+        p.wait()
+
+def __ad2dict__( ad ):
+    data = {}
+    for key in ad.keys():
+        try:
+            data[key] = ad.eval( key )
+        except Exception:
+            data[key] = str( ad[key] )
+    return data
+
+ATTR_RE = re.compile( r'^(\w+)\s*=\s*(.*?)\s*$' )
+INT_RE = re.compile( r'^-?\d+$' )
+FLOAT_RE = re.compile( r'^-?\d+\.\d*(?:[eE][-+]?\d+)?$' )
+
+def __iter_classads__( lines ):
+    """Parse -long output line by line, yielding each ClassAd as a dict
+
+    Ads are separated by blank lines; only the current ad is held in memory.
+    """
+    ad = {}
+    for line in lines:
+        matched = ATTR_RE.match( line )
+        if matched:
+            ad[matched.group(1)] = __classad_value__( matched.group(2) )
+        elif not line.strip() and ad:
+            yield ad
+            ad = {}
+    if ad:
+        yield ad
+
+def __classad_value__( text ):
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        return text[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    if INT_RE.match( text ):
+        return int(text)
+    if FLOAT_RE.match( text ):
+        return float(text)
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    return text
+
+def __job_id__( ad ):
+    return "%s.%s" % (ad.get("ClusterId"), ad.get("ProcId"))
+
+def __command__( ad ):
+    cmd = os.path.basename( str(ad.get("Cmd", "")) )
+    if ad.get("Args"):
+        cmd = "%s %s" % (cmd, ad["Args"])
+    return cmd
+
+def __date__( timestamp ):
+    if not timestamp:
+        return "???"
+    t = time.localtime( timestamp )
+    return "%d/%d %02d:%02d" % (t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min)
+
+def __duration__( secs ):
+    secs = max(0, int(secs))
+    return "%d+%02d:%02d:%02d" % (secs / 86400, secs % 86400 / 3600,
+                                 secs % 3600 / 60, secs % 60)
+
 def __text2dict__( text, **kwargs ):
   values_line = 1
   lines = text.split("\n")
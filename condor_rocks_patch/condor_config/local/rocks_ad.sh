@@ -9,3 +9,9 @@
 
 ## TODO: Implement rocks info extraction script.
 echo "ROCKS_HOSTNAME = $(/bin/hostname)"
+
+## VC images staged in the local pragma_boot repository, as a comma separated
+## list, so pcc can tell whether a launch's image is already there
+VM_IMAGES_DIR=${VM_IMAGES_DIR:-/opt/pragma_boot/vm-images}
+IMAGES=$(/bin/ls -1 $VM_IMAGES_DIR 2>/dev/null | sed 's/\.[^.]*$//' | sort -u | paste -sd, -)
+echo "ROCKS_VC_IMAGES = \"$IMAGES\""
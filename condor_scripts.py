@@ -21,6 +21,7 @@ import sys
 import os
 import json
 import subprocess
+import time
 import condor_module
 from optparse import OptionParser
 #from argparse import ArgumentParser
@@ -36,6 +37,17 @@ PROFILE = 0
 
 
 
+def parse_date(value):
+    '''Convert YYYY-MM-DD[ HH:MM] or secs since epoch to secs since epoch.'''
+    if value is None or value.isdigit():
+        return value and int(value)
+    for format in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(value, format)))
+        except ValueError:
+            pass
+    raise ValueError("Unrecognized date '%s'" % value)
+
 def main(argv=None):
     '''Command line options.'''
 
@@ -59,6 +71,13 @@ def main(argv=None):
         parser.add_option("-o", "--out", dest="outfile", help="set output path [default: %default]", metavar="FILE")
         
         parser.add_option("-f", "--format", dest="format", help="Output Format: json, text")
+        parser.add_option("-S", "--server", dest="server", help="send the request to a condor_service.py listening on this Unix socket", metavar="SOCKET")
+        parser.add_option("-m", "--max-age", dest="max_age", type="int", help="condor_status, condor_q: reuse cached results up to this many secs old (0 to always query)")
+        parser.add_option("-c", "--constraint", dest="constraint", help="condor_history: only jobs matching this ClassAd expression")
+        parser.add_option("-a", "--attributes", dest="attributes", help="condor_history: comma-separated attributes to return")
+        parser.add_option("-l", "--limit", dest="limit", type="int", help="condor_history: max number of jobs to return")
+        parser.add_option("-s", "--since", dest="since", help="condor_history: jobs completed at or after DATE (YYYY-MM-DD or secs since epoch)", metavar="DATE")
+        parser.add_option("-u", "--until", dest="until", help="condor_history: jobs completed at or before DATE (YYYY-MM-DD or secs since epoch)", metavar="DATE")
         parser.add_option("-v", "--verbose", dest="verbose", action="count", help="set verbosity level [default: %default]")
         
         # set defaults
@@ -66,20 +85,42 @@ def main(argv=None):
 
         # process options
         (opts, args) = parser.parse_args(argv)
-        if opts.verbose > 0:
-            print("verbosity level = %d" % opts.verbose)
-        if opts.infile:
-            print("infile = %s" % opts.infile)
-        if opts.outfile:
-            print("outfile = %s" % opts.outfile)
-        if opts.format:
-            print("json = %s" % opts.format)
-        
-        for a in args:
-            print a
+        # keep JSON output (e.g. condor_history NDJSON) free of anything else
+        if opts.format != "json":
+            if RUN:
+                condor_module.printTest("RUN")
+            if opts.verbose > 0:
+                print("verbosity level = %d" % opts.verbose)
+            if opts.infile:
+                print("infile = %s" % opts.infile)
+            if opts.outfile:
+                print("outfile = %s" % opts.outfile)
+            if opts.format:
+                print("json = %s" % opts.format)
+
+            for a in args:
+                print a
         
         # MAIN BODY #
-        condor_module.condorCLI(args,opts.format)
+        cli_opts = {}
+        if args and args[0] in ("condor_status", "condor_q"):
+            cli_opts = dict(max_age=opts.max_age)
+        if args and args[0] == "condor_history":
+            cli_opts = dict(constraint=opts.constraint, limit=opts.limit,
+                                since=parse_date(opts.since), until=parse_date(opts.until))
+            if opts.attributes:
+                cli_opts["attributes"] = opts.attributes.split(",")
+        if opts.server:
+            import condor_service
+            request = dict(cli_opts, command=args[0], format=opts.format)
+            # the service runs elsewhere, so send paths it can open as given
+            if args[0] == "condor_submit" and len(args) > 2:
+                request["files"] = [os.path.abspath(f) for f in args[1:]]
+            elif args[0] == "condor_submit":
+                request["file"] = os.path.abspath(args[1])
+            condor_service.query(opts.server, request)
+        else:
+            condor_module.condorCLI(args,opts.format,**cli_opts)
         
     except Exception, e:
         indent = len(program_name) * " "
@@ -89,8 +130,6 @@ def main(argv=None):
 
 
 if __name__ == "__main__":
-    if RUN:
-        condor_module.printTest("RUN")
     if DEBUG:
         sys.argv.append("-h")
     if TESTRUN:
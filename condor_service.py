@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+condor_service -- long-running condor query service
+
+Listens on a local Unix socket and answers condor status, queue, history and
+submit requests using condor_module, so callers such as the web frontend do
+not pay for a Python start-up and a condor_* process per request.  Queries go
+through the htcondor Python bindings when they are installed and through a
+bounded set of condor_* subprocesses otherwise; status and queue answers are
+shared through condor_module's snapshot cache.
+
+Each connection carries one request, a single line of JSON:
+
+  {"command": "condor_status", "format": "json", "max_age": 30}
+  {"command": "condor_q"}
+  {"command": "condor_history", "constraint": "Owner == \"yuan\"",
+   "attributes": ["Owner", "ExitCode"], "limit": 10, "since": 1394800000}
+  {"command": "condor_submit", "file": "/path/to/job.sub"}
+  {"command": "condor_submit", "files": ["/path/to/vc1.sub", "/path/to/vc2.sub"]}
+
+and the reply is what condor_scripts.py prints for the same command.  Errors
+are returned as {"error": "..."}.
+
+Usage:
+      $ condor_service.py --socket /var/run/condor_module/condor.sock
+'''
+
+import json
+import os
+import socket
+import SocketServer
+import sys
+import condor_module
+from optparse import OptionParser
+
+default_socket = os.path.join(condor_module.snapshot_dir, "condor.sock")
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            answer(json.loads(self.rfile.readline()), self.wfile)
+        except Exception, e:
+            self.wfile.write(json.dumps({"error": repr(e)}) + "\n")
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def answer(request, out):
+    '''Write the reply to one request to out.'''
+    command = request.get("command")
+    format = request.get("format", "json")
+    if command == "condor_status":
+        condor_module.condor_status(format, request.get("max_age"), out=out)
+    elif command == "condor_q":
+        condor_module.condor_q(format, request.get("max_age"), out=out)
+    elif command == "condor_history":
+        condor_module.condor_history(format, request.get("constraint"),
+                                     request.get("attributes"), request.get("limit"),
+                                     request.get("since"), request.get("until"), out=out)
+    elif command == "condor_submit" and "files" in request:
+        condor_module.condor_submit_bulk_cli(request["files"], format, out=out)
+    elif command == "condor_submit":
+        condor_module.condor_submit([command, request["file"]], format, out=out)
+    else:
+        raise ValueError("Unknown command '%s'" % command)
+
+def serve(socket_path, mode=0660):
+    '''Answer requests on socket_path until interrupted.'''
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = QueryServer(socket_path, QueryHandler)
+    os.chmod(socket_path, mode)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def query(socket_path, request, out=None):
+    '''Send one request to a running service and copy the reply to out.'''
+    out = out or sys.stdout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall(json.dumps(request) + "\n")
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            out.write(data)
+    finally:
+        sock.close()
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--socket", dest="socket", default=default_socket,
+                      help="Unix socket to listen on [default: %default]", metavar="PATH")
+    parser.add_option("-m", "--mode", dest="mode", default="0660",
+                      help="permissions of the socket [default: %default]")
+    (opts, args) = parser.parse_args(argv)
+    socket_dir = os.path.dirname(opts.socket)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    serve(opts.socket, int(opts.mode, 8))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""mail_queue.py
+
+Durable queue of notification emails kept in a SQLite database (WAL).
+
+pcc-check-reservations.py only adds messages to the queue, so a slow or
+stuck MTA can not hold up a sweep.  A sender, either `pcc-check-reservations.py
+--flush-mail` run from cron or a thread of the daemon, empties the queue over
+a single SMTP connection that it reuses for every message.  Messages for the
+same recipient that arrive within the digest window of each other are sent as
+one digest.  Messages that fail to send are retried with exponential backoff
+and dropped after a number of attempts.
+"""
+
+from email.mime.text import MIMEText
+import fcntl
+import logging
+import os
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+
+default_path = "/var/spool/pcc/mail.db"
+
+
+class MailQueue:
+  def __init__(self, path=default_path):
+    self.path = path
+    self.lock = threading.Lock()
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        queued REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_try REAL NOT NULL);
+      CREATE INDEX IF NOT EXISTS messages_recipient
+        ON messages (recipient, id);
+    """)
+
+  def put(self, sender, recipient, subject, body):
+    """Add a message to the queue"""
+    now = time.time()
+    with self.lock:
+      with self.db:
+        self.db.execute(
+          "INSERT INTO messages (sender, recipient, subject, body, queued, "
+          "next_try) VALUES (?, ?, ?, ?, ?, ?)",
+          (sender, recipient, subject, body, now, now))
+
+  def flush(self, smtp_host="localhost", digest_secs=60, retry_secs=60,
+            max_retry_secs=3600, max_attempts=10, force=False):
+    """Send the messages that are due over one SMTP connection
+
+      The messages of a recipient are due once the newest of them is
+      digest_secs old, so status changes that arrive close together are sent
+      as a single digest, and once their retry backoff has passed.
+
+      Args:
+        smtp_host(string): SMTP server to send through
+        digest_secs(int): secs to wait for more messages to the same recipient
+        retry_secs(int): secs to wait before the first retry of a message
+        max_retry_secs(int): max secs between retries
+        max_attempts(int): attempts after which a message is dropped
+        force(bool): send all messages now, ignoring the digest window
+
+      Returns:
+        int: number of emails sent
+    """
+    # only one sender at a time, e.g. the daemon and a --flush-mail from cron
+    lock = open(self.path + ".lock", "a")
+    try:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        logging.debug("Mail queue is being sent by another process")
+        return 0
+      return self._flush(smtp_host, digest_secs, retry_secs, max_retry_secs,
+                         max_attempts, force)
+    finally:
+      lock.close()
+
+  def _flush(self, smtp_host, digest_secs, retry_secs, max_retry_secs,
+             max_attempts, force):
+    now = time.time()
+    with self.lock:
+      rows = self.db.execute(
+        "SELECT id, sender, recipient, subject, body, attempts FROM messages "
+        "WHERE recipient IN (SELECT recipient FROM messages GROUP BY recipient "
+        "HAVING MAX(queued) <= ? AND MAX(next_try) <= ?) ORDER BY id",
+        (now if force else now - digest_secs, now)).fetchall()
+    digests = {}
+    for row in rows:
+      digests.setdefault(row[2], []).append(row)
+
+    (sent, smtp) = (0, None)
+    try:
+      for recipient in sorted(digests):
+        messages = digests[recipient]
+        ids = [row[0] for row in messages]
+        try:
+          if smtp is None:
+            smtp = smtplib.SMTP(smtp_host)
+          msg = self.compose(messages)
+          smtp.sendmail(msg['From'], [recipient], msg.as_string())
+        except (smtplib.SMTPException, socket.error) as e:
+          attempts = max([row[5] for row in messages]) + 1
+          logging.warning("Unable to send mail to %s (attempt %d): %s" % (
+            recipient, attempts, e))
+          if isinstance(e, (smtplib.SMTPServerDisconnected, socket.error)):
+            smtp = None
+          self.retry(ids, attempts, min(max_retry_secs,
+                                        retry_secs * 2 ** (attempts - 1)),
+                     max_attempts)
+          continue
+        self.delete(ids)
+        sent += 1
+        logging.debug("Sent %d message(s) to %s" % (len(ids), recipient))
+    finally:
+      if smtp is not None:
+        try:
+          smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+          pass
+    return sent
+
+  def compose(self, messages):
+    """Return one email of messages, a digest if there are several"""
+    if len(messages) == 1:
+      (id, sender, recipient, subject, body, attempts) = messages[0]
+    else:
+      sender = messages[0][1]
+      recipient = messages[0][2]
+      subject = "%s (and %d more updates)" % (messages[-1][3],
+                                              len(messages) - 1)
+      body = ("\n%s\n\n" % ("-" * 72)).join(
+        ["Subject: %s\n\n%s" % (row[3], row[4]) for row in messages])
+    msg = MIMEText(body)
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = recipient
+    return msg
+
+  def retry(self, ids, attempts, delay, max_attempts):
+    """Schedule messages for another attempt, or drop them if they have had
+    too many"""
+    with self.lock:
+      with self.db:
+        if attempts >= max_attempts:
+          logging.error("Dropping %d message(s) after %d attempts" % (
+            len(ids), attempts))
+          self.db.executemany("DELETE FROM messages WHERE id = ?",
+                              [(id,) for id in ids])
+          return
+        self.db.executemany(
+          "UPDATE messages SET attempts = ?, next_try = ? WHERE id = ?",
+          [(attempts, time.time() + delay, id) for id in ids])
+
+  def delete(self, ids):
+    with self.lock:
+      with self.db:
+        self.db.executemany("DELETE FROM messages WHERE id = ?",
+                            [(id,) for id in ids])
+
+  def close(self):
+    self.db.close()
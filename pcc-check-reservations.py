@@ -7,6 +7,17 @@ Configuration for script is held in cloud-scheduler.cfg file
 
 Example:
       $ pcc-check-reservations.py
+      $ pcc-check-reservations.py --daemon
+      $ pcc-check-reservations.py --flush-mail
+
+By default a single sweep of all reservations is done (e.g., from cron).  With
+--daemon the script stays running, authenticates once and wakes up only when a
+reservation is due to start or stop or has a site being polled.  Send SIGHUP
+to reload cloud-scheduler.cfg.
+
+Notification emails are queued in a local spool and sent by a separate
+sender: a thread of the daemon, the end of a sweep, or --flush-mail, which
+sends everything queued and exits.
 
 cloud-scheduler.cfg attributes:
   Authentication:
@@ -14,31 +25,101 @@ cloud-scheduler.cfg attributes:
     password: password to authenticate to Booked 
   Server
     hostname: Booked hostname
+    maxConnections: max idle keep-alive connections to Booked (default 4)
+    maxRetries: times to retry an idempotent API call (default 2)
   Logging
     file: name of log file
     level: verbosity of logging (INFO, DEBUG)
   Stopping
     reservationSecsLeft: stop PCC when specified secs left in reservation 
+    siteTimeout: max secs for the shutdown or clean of a site's cluster
+                 (default 600)
+  Concurrency
+    workers: number of reservations to process at the same time (default 1)
+  Cache
+    ttl: secs to reuse user data and site descriptions (default 3600)
+    dir: directory to save caches in between runs (optional)
+  SSH
+    controlDir: directory for ssh ControlMaster sockets (default /tmp/pcc-ssh)
+    controlPersist: secs to keep idle ssh connections open (default 600)
+  Probe
+    deadline: max secs to wait for a frontend's SSH banner (default 30)
+    cacheTTL: secs to reuse the result of an SSH probe (default 60)
+    listTTL: secs to reuse a host's `pragma list cluster` (default 60)
+  Launch
+    perHostConcurrency: max pragma_boot launches at a time per host
+                        (default 2)
+    confirmTimeout: max secs to wait for a launch to be confirmed
+                    (default 120)
+  Index
+    file: virtual cluster index read by vc-manager.py qstat
+          (default /var/run/pcc/vc-index.db)
+    pool: pool name reservations are listed under (default pragma)
+  Mail
+    spool: queue of notification emails (default /var/spool/pcc/mail.db)
+    smtpHost: SMTP server to send emails through (default localhost)
+    digestSecs: secs to wait for more updates to the same user before
+                sending them as one email (default 60)
+    retrySecs: secs before the first retry of a failed email (default 60)
+    maxRetrySecs: max secs between retries of a failed email (default 3600)
+    maxAttempts: attempts after which an email is dropped (default 10)
+    flushSecs: secs between sends of queued emails by the daemon
+               (default 30)
+  Inventory
+    ttl: secs to reuse the list of VC images staged at a host (default 600)
+  Placement
+    check: check each site can fit its cluster before launching it
+           (default true)
+    registry: vc-manager.py resource registry used when Condor has no
+              slots for a site, and in which the cores and memory of each
+              launched cluster are claimed until it is torn down
+              (default /var/lib/pcc/vc-registry.db)
+  Staging
+    leadSecs: secs before a reservation starts to write its DAG, copy it to
+              its hosts and check they are ready, so only `pragma boot` is
+              left at the start (default 0, stage at the start)
+  Sync
+    incremental: only handle changed or soon-due reservations (default true)
+    deadlineWindow: secs before a deadline to handle a reservation
+                    (default 600)
+  Daemon
+    refreshSecs: secs between fetches of all reservations (default 300)
+    pollMinSecs: initial secs between polls of a starting site (default 30)
+    pollMaxSecs: max secs between polls of a starting or running site
+                 (default 300)
 """
 
+import boot_progress
+import calendar
+import condor_module
 from ConfigParser import ConfigParser
 from datetime import datetime
-from email.mime.text import MIMEText
-import glob
+import hashlib
+import heapq
+import httplib
 from httplib import HTTPSConnection
 import json
 import logging
+import mail_queue
 from logging.handlers import TimedRotatingFileHandler
+from optparse import OptionParser
 import os
+from Queue import Empty, Queue
 import re
+import select
+import signal
 from string import Template
 import socket
-import smtplib
+import sqlite3
 import ssl
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import urllib
+import vc_index
+import vc_registry
 
 ISO_FORMAT = "%Y-%m-%d %H:%M:%S"
 ISO_LENGTH = 19
@@ -104,6 +185,170 @@ LOGIN_INFO = """
 """
 
 
+# Booked API functions that only read state and so are always safe to resend
+IDEMPOTENT_FUNCTIONS = [
+  "signIn.py",
+  "pccGetAllReservations.py",
+  "getUserData.py",
+  "GetSiteDescription.py"
+]
+
+# cloud-scheduler.cfg contents; read in main() and re-read on SIGHUP
+config = None
+
+
+class HTTPSConnectionPool:
+  """Pool of persistent (keep-alive) HTTPS connections to a single host
+
+  Connections are handed back to the pool after each response has been read
+  so that later requests reuse the same TLS session instead of doing a new
+  handshake.  Counters of connections opened, requests sent and retries are
+  kept so usage can be reported per sweep.
+  """
+
+  def __init__(self, host, max_idle=4, max_retries=2):
+    self.host = host
+    self.max_idle = max_idle
+    self.max_retries = max_retries
+    self.idle = []
+    self.lock = threading.Lock()
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.connections_opened = 0
+    self.requests_sent = 0
+    self.retries = 0
+
+  def stats(self):
+    return "%d connections, %d requests, %d retries" % (
+      self.connections_opened, self.requests_sent, self.retries)
+
+  def _connect(self):
+    connection = HTTPSConnection(
+      self.host, context=ssl._create_unverified_context())
+    connection.connect()
+    with self.lock:
+      self.connections_opened += 1
+    return connection
+
+  def _get(self):
+    """Return an idle connection if there is one, otherwise open a new one
+
+      Returns:
+        tuple: (HTTPSConnection, bool True if connection is being reused)
+    """
+    with self.lock:
+      if self.idle:
+        return self.idle.pop(), True
+    return self._connect(), False
+
+  def _put(self, connection):
+    with self.lock:
+      if len(self.idle) < self.max_idle:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  def request(self, method, path, body, idempotent=True):
+    """Send a request over a pooled connection
+
+      A connection the server dropped while idle is detected when the request
+      fails on it and is replaced by a fresh one.  Failures on a fresh
+      connection are only retried for idempotent requests.
+
+      Args:
+        method(string): POST or GET
+        path(string): URL path
+        body(string): encoded request body
+        idempotent(bool): True if request may safely be resent
+
+      Returns:
+        tuple: (HTTPResponse, string body of response)
+    """
+    attempt = 0
+    while True:
+      (connection, reused) = self._get()
+      try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        data = response.read()
+      except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        if attempt >= self.max_retries or not (reused or idempotent):
+          raise
+        attempt += 1
+        with self.lock:
+          self.retries += 1
+        logging.debug("  Retrying %s after error: %s" % (path, str(e)))
+        continue
+      with self.lock:
+        self.requests_sent += 1
+      if response.will_close:
+        connection.close()
+      else:
+        self._put(connection)
+      return response, data
+
+  def close(self):
+    with self.lock:
+      (idle, self.idle) = (self.idle, [])
+    for connection in idle:
+      connection.close()
+
+
+class LookupCache:
+  """Thread-safe cache of API lookups keyed by ID with a time-to-live
+
+  Entries older than ttl seconds are treated as missing.  If a filename is
+  given the cache is loaded from it on creation and can be saved back with
+  save() so entries survive between cron runs.
+  """
+
+  def __init__(self, ttl, filename=None):
+    self.ttl = ttl
+    self.filename = filename
+    self.entries = {}
+    self.lock = threading.Lock()
+    if filename and os.path.exists(filename):
+      try:
+        f = open(filename, "r")
+        self.entries = json.load(f)
+        f.close()
+      except (IOError, ValueError) as e:
+        logging.warning("  Ignoring unreadable cache %s: %s" % (filename, e))
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(str(key))
+    if entry and time.time() - entry[0] < self.ttl:
+      return entry[1]
+    return None
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[str(key)] = [time.time(), value]
+
+  def save(self):
+    """Write unexpired entries to the cache file, if there is one"""
+    if not self.filename:
+      return
+    now = time.time()
+    with self.lock:
+      entries = dict([(k, v) for (k, v) in self.entries.items()
+                      if now - v[0] < self.ttl])
+    tmp_filename = "%s.%d" % (self.filename, os.getpid())
+    f = os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0600), "w")
+    json.dump(entries, f)
+    f.close()
+    os.rename(tmp_filename, self.filename)
+
+
+class GUIClientError(Exception):
+  """Raised when the Booked API returns an error response"""
+  pass
+
+
 class GUIClient:
   def __init__(self, config):
     self.host = config.get("Server", "hostname")
@@ -111,39 +356,50 @@ class GUIClient:
     self.password = config.get("Authentication", "password")
     self.base_url = config.get("Server", "baseUrl")
     self.session_id = None
+    self.pool = HTTPSConnectionPool(
+      self.host,
+      int(getConfigOption(config, "Server", "maxConnections", 4)),
+      int(getConfigOption(config, "Server", "maxRetries", 2)))
+    ttl = int(getConfigOption(config, "Cache", "ttl", 3600))
+    cache_dir = getConfigOption(config, "Cache", "dir", None)
+    self.users = LookupCache(
+      ttl, cache_dir and os.path.join(cache_dir, "users.json"))
+    self.sites = LookupCache(
+      ttl, cache_dir and os.path.join(cache_dir, "sites.json"))
 
   def authenticate(self):
     logging.info("Authenticating to Cloud GUI")
-    connection = HTTPSConnection(
-      self.host, context=ssl._create_unverified_context())
-    connection.connect()
-
     creds = {"username": self.username, "password": self.password}
     auth_url = "%s/signIn.py" % self.base_url
-    session = self._run_query(connection, auth_url, "POST", creds)
+    session = self._run_query(auth_url, "POST", creds)
     self.session_id = session["session_id"]
-    connection.close()
 
-  def _run_query(self, connection, path, method, params):
+  def close(self):
+    self.pool.close()
+    for cache in (self.users, self.sites):
+      try:
+        cache.save()
+      except (IOError, OSError) as e:
+        logging.warning("  Unable to save cache %s: %s" % (cache.filename, e))
+
+  def _run_query(self, path, method, params, idempotent=True):
     """
     Send a REST API request
 
     Args:
-      connection(HTTPConnection): An already open HTTPConnection
       path(string): REST API path function
       method(string): POST or GET
       params(string): Arguments to REST function
+      idempotent(bool): True if request may safely be resent
 
     Returns:
       JSON object: response from server
     """
-    connection.request(method, path, urllib.urlencode(params))
-    response = connection.getresponse()
+    (response, responsestring) = self.pool.request(
+      method, path, urllib.urlencode(params), idempotent)
     if response.status != 200:
-      sys.stderr.write("Problem querying " + path + ": " + response.reason)
-      sys.stderr.write(response.read())
-      sys.exit(1)
-    responsestring = response.read()
+      raise GUIClientError("Problem querying %s: %s\n%s" % (
+        path, response.reason, responsestring))
     return json.loads(responsestring)
 
   def query(self, function, method, params):
@@ -159,25 +415,52 @@ class GUIClient:
         dict: contains Booked auth info
         JSON object: response from server
     """
-    connection = HTTPSConnection(self.host, context=ssl._create_unverified_context())
-    connection.connect()
-
     if not params:
       params = {}
     params['session_id'] = self.session_id
 
     url = "%s/%s" % (self.base_url, function)
     logging.debug("  Sending API call: " + url)
-    data = self._run_query(connection, url, method, params)
-    connection.close()
-    return data
+    return self._run_query(
+      url, method, params, function in IDEMPOTENT_FUNCTIONS)
+
+  def query_user(self, username):
+    """Return user data for username, from the cache when still fresh"""
+    userdata = self.users.get(username)
+    if userdata is None:
+      userdata = self.query("getUserData.py", "POST", {'username': username})
+      self.users.put(username, userdata)
+    return userdata
 
   def query_site(self, params):
-    responsedata = self.query("GetSiteDescription.py", "POST", params)
-    if 'site' in responsedata:
-      return responsedata['site']
-    else:
-      return None
+    """Return the description of params['site_id'], cached by site ID"""
+    site = self.sites.get(params['site_id'])
+    if site is None:
+      responsedata = self.query("GetSiteDescription.py", "POST", dict(params))
+      if 'site' not in responsedata:
+        return None
+      site = responsedata['site']
+      self.sites.put(params['site_id'], site)
+    return site
+
+  def prefetch(self, reservations, pool):
+    """Fill the caches for every distinct owner and site in reservations
+
+      Args:
+        reservations(list): reservation records from Booked
+        pool(WorkerPool): pool to run the lookups in
+    """
+    (users, sites) = ({}, {})
+    for reservation in reservations:
+      users[reservation['owner']] = True
+      for site in reservation['sites']:
+        sites.setdefault(site['site_id'], {
+          'reservation_id': reservation['reservation_id'],
+          'site_id': site['site_id']})
+    logging.debug("  Prefetching %d users and %d sites" % (
+      len(users), len(sites)))
+    pool.map(self.query_user, users.keys())
+    pool.map(self.query_site, sites.values())
 
   def update_status(self, reservation, site, new_status, description=None):
     """Send reservation update request
@@ -229,6 +512,7 @@ class Reservation:
     now = datetime.utcnow()
     logging.info(
       "  Start: %s, End %s" % (reservation['begin'], reservation['end']))
+    self.start = start
     self.start_diff = start - now
     self.end_diff = end - now
     self.shutdown_secs = int(config.get("Stopping", "reservationSecsLeft"))
@@ -245,13 +529,25 @@ class Reservation:
     logging.info("  Calling reservation handle function '%s'" % target_status)
     self.params['site_id'] = site['site_id']
     site_desc = self.client.query_site(self.params)
+    hostname = site_desc and site_desc['site_hostname']
+    callIndex(
+      "update", getIndexPool(), self.reservation['reservation_id'],
+      site['site_id'], status=site['status'], hostname=hostname)
     handle_func = getattr(self, target_status)
     if handle_func:
-      (success, desc) = handle_func(site, site_desc)
+      # a handler returns (success, description) or, to move the site to a
+      # status other than the usual next one, (success, description, status)
+      result = handle_func(site, site_desc)
+      (success, desc) = result[:2]
+      if len(result) > 2:
+        target_status = result[2]
       if success:
         (update_result, self.reservation) = self.client.update_status(
           self.reservation, site, target_status, desc)
         if update_result:
+          callIndex(
+            "update", getIndexPool(), self.reservation['reservation_id'],
+            site['site_id'], status=target_status)
           return target_status, self.reservation
     else:
       logging.debug("  Reservation in unknown state to PCC")
@@ -262,18 +558,42 @@ class Reservation:
 
   def starting(self, site, site_desc):
     logging.debug("  Reservation should be started in: " + str(self.start_diff))
-    if self.start_diff.total_seconds() <= 0:  # should be less than
-      logging.info("   Starting reservation at " + str(datetime.utcnow()))
-      self.dag.write(reservation, userdata, site, site_desc)
-      self.dag.start()
-      return True, None
-    return False, None
+    lead_secs = int(getConfigOption(config, "Staging", "leadSecs", 0))
+    if self.start_diff.total_seconds() > lead_secs:
+      return False, None
+    if getConfigOption(config, "Placement", "check", "true") == "true":
+      (decision, reason) = PlacementPlanner().plan(site, site_desc)
+      if decision == PlacementPlanner.REJECT:
+        # final: the site is stopped and its owner told why
+        logging.error("   Rejecting reservation: %s" % reason)
+        return True, "Rejected: %s" % reason, "stopped"
+      elif decision == PlacementPlanner.DEFER:
+        logging.info("   Deferring reservation: %s" % reason)
+        callIndex(
+          "update", getIndexPool(), self.reservation['reservation_id'],
+          site['site_id'], status=decision)
+        return False, None
+      logging.debug("   Placement: %s" % reason)
+    self.dag.write(self.reservation, self.user, site, site_desc)
+    if self.start_diff.total_seconds() > 0:  # within the staging lead time
+      if not self.dag.is_staged(site['site_id']):
+        logging.info("   Staging reservation %d secs before it starts" %
+                     self.start_diff.total_seconds())
+        self.dag.stage(site['site_id'])
+      return False, None
+    logging.info("   Starting reservation at " + str(datetime.utcnow()))
+    return self.dag.start(site['site_id']), None
 
   def running(self, site, site_desc):
     logging.info("   Checking status of reservation ")
     info = self.dag.is_running()
     if info:
-      logging.info("   Reservation is running")
+      delay = (datetime.utcnow() - self.start).total_seconds()
+      logging.info("   Reservation is running; reachable by SSH %d secs "
+                   "after its scheduled start" % delay)
+      callIndex(
+        "update", getIndexPool(), self.reservation['reservation_id'],
+        site['site_id'], ssh_delay=delay)
       return True, info
     return False, None
 
@@ -285,7 +605,7 @@ class Reservation:
       shutdownTime = self.end_diff.total_seconds() - self.shutdown_secs
       logging.debug(
         "  Reservation scheduled to be shut down in %s or %d secs" % (
-          str(res.end_diff), shutdownTime))
+          str(self.end_diff), shutdownTime))
       return False, None
     else:
       logging.info("  Reservation has expired; shutting down cluster")
@@ -295,35 +615,625 @@ class Reservation:
     return False, None
 
   def stopping(self, site, site_desc):
-    pass
+    logging.info("  Retrying teardown of cluster")
+    if self.dag.stop():
+      return True, "--", "stopped"
+    return False, None
 
 
-class Dag:
+class ByteCounter:
+  """File-like wrapper that counts the bytes written through it"""
 
-  def __init__(self, dag_dir, reservation_id):
-    self.dag_dir = os.path.join(dag_dir, "dag-%s" % reservation_id)
-    self.reservation_id = reservation_id
+  def __init__(self, f):
+    self.f = f
+    self.count = 0
+
+  def write(self, data):
+    self.count += len(data)
+    self.f.write(data)
 
-  def _run_shell_command(self, cmd, stdout_filename):
-    """Run bash shell command
+
+class RemoteShell:
+  """Multiplexed SSH connection to username@hostname shared by all commands
+
+  The first command to a host starts a persistent ssh ControlMaster; later
+  ssh calls to the same host reuse its connection instead of doing a new
+  TCP connect and key exchange.  Commands are run without a local shell and
+  their output is returned in memory.  Connection setup and
+  command times are logged.
+  """
+
+  shells = {}
+  shells_lock = threading.Lock()
+
+  @classmethod
+  def get(cls, username, hostname):
+    """Return the shared RemoteShell for username@hostname"""
+    with cls.shells_lock:
+      key = (username, hostname)
+      if key not in cls.shells:
+        cls.shells[key] = RemoteShell(
+          username, hostname,
+          getConfigOption(config, "SSH", "controlDir", "/tmp/pcc-ssh"),
+          int(getConfigOption(config, "SSH", "controlPersist", 600)))
+      return cls.shells[key]
+
+  def __init__(self, username, hostname, control_dir, control_persist):
+    self.target = "%s@%s" % (username, hostname)
+    self.hostname = hostname
+    if not os.path.exists(control_dir):
+      try:
+        os.makedirs(control_dir, 0700)
+      except OSError:
+        pass  # created by another thread
+    self.options = [
+      "-o", "ControlMaster=auto",
+      "-o", "ControlPath=%s" % os.path.join(control_dir, "%r@%h:%p"),
+      "-o", "ControlPersist=%d" % control_persist,
+      "-o", "BatchMode=yes"]
+    self.lock = threading.Lock()
+    self.connected = False
+
+  def connect(self):
+    """Start the master connection if it is not already up"""
+    with self.lock:
+      if self.connected:
+        return
+      start = time.time()
+      if subprocess.call(["ssh", "-O", "check"] + self.options + [self.target],
+                         stdout=open(os.devnull, "w"),
+                         stderr=subprocess.STDOUT) != 0:
+        subprocess.call(["ssh", "-M", "-N", "-f"] + self.options + [self.target])
+      self.connected = True
+      logging.debug("  SSH connection to %s set up in %.2fs" % (
+        self.target, time.time() - start))
+
+  def _call(self, program, flags, args, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, timeout=None):
+    self.connect()
+    start = time.time()
+    p = subprocess.Popen([program] + flags + self.options + args,
+                         stdout=stdout, stderr=stderr)
+    timer = None
+    if timeout:
+      timer = threading.Timer(timeout, p.kill)
+      timer.start()
+    try:
+      (out, err) = p.communicate()
+    finally:
+      if timer:
+        timer.cancel()
+    logging.debug("  %s %s (exit %d, %.2fs)" % (
+      program, " ".join(args), p.returncode, time.time() - start))
+    if p.returncode != 0 and err:
+      logging.debug("  %s" % err.strip())
+    return (p.returncode, out)
+
+  def run(self, command, timeout=None):
+    """Run command on the remote host
 
       Args:
-        stdout_filename: put stdout in specified filename
+        command(string): command line, interpreted by the remote shell
+        timeout(int): secs after which ssh is killed (default no limit)
 
       Returns:
-        exit code of cmd
+        tuple: (exit code, stdout text)
     """
+    return self._call("ssh", [], [self.target, command], timeout=timeout)
+
+  def run_background(self, command, stdout_filename):
+    """Run command on the remote host and return once ssh has forked
 
+      Args:
+        command(string): command line, interpreted by the remote shell
+        stdout_filename(string): local file to get the command's output
+
+      Returns:
+        int: exit code of ssh
+    """
     stdout_f = open(stdout_filename, "w")
-    result = subprocess.call(cmd, stdout=stdout_f, shell=True)
+    (result, out) = self._call("ssh", ["-f"], [self.target, command],
+                               stdout=stdout_f, stderr=stdout_f)
     stdout_f.close()
+    return result
+
+  def send_files(self, local_dir, paths, remote_dir):
+    """Stream files to the remote host as a single compressed tar archive
 
-    f = open(stdout_filename, "r")
-    stdout_text = f.read()
+      Args:
+        local_dir(string): directory that paths are relative to
+        paths(list): relative paths of the files to send
+        remote_dir(string): directory to unpack the files into
+
+      Returns:
+        tuple: (exit code of remote tar, bytes sent)
+    """
+    self.connect()
+    start = time.time()
+    p = subprocess.Popen(
+      ["ssh"] + self.options + [self.target, "mkdir -p %s && tar xzf - -C %s" % (
+        remote_dir, remote_dir)],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    counter = ByteCounter(p.stdin)
+    archive = tarfile.open(fileobj=counter, mode="w|gz")
+    for path in paths:
+      archive.add(os.path.join(local_dir, path), arcname=path)
+    archive.close()
+    (out, err) = p.communicate()
+    logging.debug("  tar of %d files to %s:%s (exit %d, %.2fs)" % (
+      len(paths), self.target, remote_dir, p.returncode, time.time() - start))
+    if p.returncode != 0 and out:
+      logging.debug("  %s" % out.strip())
+    return (p.returncode, counter.count)
+
+
+class SSHProbe:
+  """Checks whether hosts accept SSH connections, with a short-lived cache
+
+  All addresses passed to check() are probed at the same time using
+  non-blocking sockets: a host is up when it sends an SSH banner before the
+  deadline.  Results are cached for ttl secs and concurrent callers asking
+  about an address already being probed wait for that probe, so a sweep
+  never probes the same address twice.  prefetch() probes the addresses of
+  every starting reservation of a sweep in one go before any is handled.
+  """
+
+  shared = None
+  shared_lock = threading.Lock()
+
+  @classmethod
+  def get(cls):
+    """Return the SSHProbe shared by all reservations"""
+    with cls.shared_lock:
+      if cls.shared is None:
+        cls.shared = SSHProbe(
+          int(getConfigOption(config, "Probe", "cacheTTL", 60)),
+          int(getConfigOption(config, "Probe", "deadline", 30)))
+      return cls.shared
+
+  def __init__(self, ttl, deadline, port=22):
+    self.ttl = ttl
+    self.deadline = deadline
+    self.port = port
+    self.results = {}
+    self.inflight = {}
+    self.lock = threading.Lock()
+
+  def prefetch(self, reservations):
+    """Probe at once the public IPs of the starting sites of all
+    reservations, as found on earlier polls, so that each reservation's
+    Dag.is_running finds them cached instead of probing on its own
+
+      Args:
+        reservations(list): reservation records from Booked
+    """
+    starting = set()
+    for reservation in reservations:
+      for site in reservation['sites']:
+        if site['status'] == 'starting':
+          starting.add((str(reservation['reservation_id']),
+                        str(site['site_id'])))
+    if not starting:
+      return
+    addresses = [row['public_ip'] for row in
+                 callIndex("query", pool=getIndexPool()) or []
+                 if row['public_ip'] and
+                 (row['reservation_id'], row['site_id']) in starting]
+    logging.debug("  Prefetching SSH status of %d addresses" % len(addresses))
+    self.check(addresses)
+
+  def check(self, addresses):
+    """Probe addresses for a running SSH daemon
+
+      Args:
+        addresses(list): IP addresses to check
+
+      Returns:
+        dict: address -> True if SSH is up, False otherwise
+    """
+    (results, waiting, probing) = ({}, {}, [])
+    now = time.time()
+    with self.lock:
+      for address in set(addresses):
+        if address in self.results and now - self.results[address][0] < self.ttl:
+          results[address] = self.results[address][1]
+        elif address in self.inflight:
+          waiting[address] = self.inflight[address]
+        else:
+          self.inflight[address] = threading.Event()
+          probing.append(address)
+    probed = {}
+    try:
+      probed = self._probe(probing)
+    finally:
+      with self.lock:
+        for address in probing:
+          self.results[address] = (time.time(), probed.get(address, False))
+          self.inflight.pop(address).set()
+    for address in probing:
+      results[address] = probed.get(address, False)
+    for address, event in waiting.items():
+      event.wait()
+      results[address] = self.results[address][1]
+    return results
+
+  def _probe(self, addresses):
+    """Connect to all addresses at once and wait for their SSH banners"""
+    (connecting, reading, up) = ({}, {}, {})
+    for address in addresses:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setblocking(0)
+      sock.connect_ex((address, self.port))
+      connecting[sock] = address
+    end = time.time() + self.deadline
+    while (connecting or reading) and time.time() < end:
+      (readable, writable, errored) = select.select(
+        reading.keys(), connecting.keys(), [], max(0, end - time.time()))
+      for sock in writable:
+        address = connecting.pop(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+          reading[sock] = [address, ""]
+        else:
+          sock.close()
+      for sock in readable:
+        try:
+          data = sock.recv(256)
+        except socket.error:
+          data = ""
+        reading[sock][1] += data
+        (address, banner) = reading[sock]
+        if not data or banner.startswith("SSH-") or len(banner) >= 4:
+          up[address] = banner.startswith("SSH-")
+          del reading[sock]
+          sock.close()
+    for sock in connecting.keys() + reading.keys():
+      sock.close()
+    return up
+
+
+class ImageInventory:
+  """Knows which VC images are staged at each host
+
+  A host's images come from the ROCKS_VC_IMAGES attribute rocks_ad.sh adds
+  to its Condor slots, or else from `pragma list repository` run on it, and
+  are reused for ttl secs.  They are saved in the virtual cluster index,
+  where each launch also records whether its image was warm, i.e. already
+  staged at its host, so image cache hit rates can be reported.
+  """
+
+  shared = None
+  shared_lock = threading.Lock()
+
+  @classmethod
+  def get(cls):
+    """Return the ImageInventory shared by all reservations"""
+    with cls.shared_lock:
+      if cls.shared is None:
+        cls.shared = ImageInventory(
+          int(getConfigOption(config, "Inventory", "ttl", 600)))
+      return cls.shared
+
+  @staticmethod
+  def parse_repository(text):
+    """Return the image names in the output of `pragma list repository`"""
+    return [line.split()[0] for line in text.splitlines()[1:]
+            if line.strip()]
+
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.images = {}
+    self.lock = threading.Lock()
+
+  def update(self, hostname, images):
+    with self.lock:
+      self.images[hostname] = (time.time(), set(images))
+    callIndex("set_images", hostname, images)
+
+  def has(self, username, hostname, pragma, image):
+    """Return True if image is staged at hostname
+
+      Args:
+        username(string): user to run pragma as on hostname
+        hostname(string): host to check
+        pragma(string): command line of pragma on hostname
+        image(string): name of the VC image
+    """
+    with self.lock:
+      cached = self.images.get(hostname)
+    if cached and time.time() - cached[0] < self.ttl:
+      return image in cached[1]
+    images = None
+    try:
+      for (machine, advertised) in condor_module.iter_images(hostname):
+        images = advertised
+    except (IOError, OSError) as e:
+      logging.debug("  Unable to query Condor for images of %s: %s" % (
+        hostname, e))
+    if images is None:
+      (result, stdout_text) = RemoteShell.get(username, hostname).run(
+        "%s list repository" % pragma)
+      if result != 0:
+        return False
+      images = ImageInventory.parse_repository(stdout_text)
+    self.update(hostname, images)
+    return image in images
+
+
+class ClusterList:
+  """Shares one `pragma list cluster` per host among all its reservations
+
+  The first reservation to ask about a cluster on a host lists every
+  cluster on that host and indexes the table by frontend; other reservations
+  on the same host are answered from that index for ttl secs, and concurrent
+  callers wait for a listing already in progress.  Remote calls per sweep
+  therefore grow with the number of hosts rather than of reservations.
+  """
+
+  shared = None
+  shared_lock = threading.Lock()
+
+  @classmethod
+  def get(cls):
+    """Return the ClusterList shared by all reservations"""
+    with cls.shared_lock:
+      if cls.shared is None:
+        cls.shared = ClusterList(
+          int(getConfigOption(config, "Probe", "listTTL", 60)))
+      return cls.shared
+
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.listings = {}
+    self.inflight = {}
+    self.lock = threading.Lock()
+
+  def lines(self, node, frontend):
+    """Return the `pragma list cluster` table of a frontend
+
+      Args:
+        node(NodeSpec): DAG node the cluster was launched for
+        frontend(string): name of the cluster's frontend
+
+      Returns:
+        list: header line and the lines of the cluster's nodes
+    """
+    listing = self.listing(node)
+    if listing and frontend in listing[1]:
+      return [listing[0]] + listing[1][frontend]
+    # not in the host's listing yet, or listing failed; ask for the cluster
+    (result, stdout_text) = RemoteShell.get(node.username, node.hostname).run(
+      "%s %s/bin/pragma list cluster %s" % (
+        node.python_path, node.pragma_boot_path, frontend))
+    return stdout_text.splitlines(True)
+
+  def listing(self, node):
+    """Return (header, {frontend: lines}) of all clusters on node's host"""
+    key = (node.username, node.hostname)
+    with self.lock:
+      cached = self.listings.get(key)
+      if cached and time.time() - cached[0] < self.ttl:
+        return cached[1]
+      event = self.inflight.get(key)
+      if event is None:
+        self.inflight[key] = threading.Event()
+    if event is not None:
+      event.wait()
+      return self.listings.get(key, (0, None))[1]
+    listing = None
+    try:
+      (result, stdout_text) = RemoteShell.get(
+        node.username, node.hostname).run("%s %s/bin/pragma list cluster" % (
+          node.python_path, node.pragma_boot_path))
+      if result == 0:
+        listing = self.parse(stdout_text)
+    finally:
+      with self.lock:
+        self.listings[key] = (time.time(), listing)
+        self.inflight.pop(key).set()
+    return listing
+
+  def parse(self, text):
+    """Split a listing into its header and the lines of each cluster
+
+      A cluster starts at an unindented line naming its frontend and takes
+      the lines of its compute nodes that follow, which are either indented
+      or, as `rocks list cluster` prints them, start with "::" in place of a
+      frontend name.
+    """
+    lines = text.splitlines(True)
+    if not lines:
+      return None
+    (clusters, current) = ({}, None)
+    for line in lines[1:]:
+      if not line.strip():
+        continue
+      name = line.split()[0].rstrip(":")
+      if not line[0].isspace() and name.strip(":-"):
+        current = name
+        clusters[current] = []
+      if current is not None:
+        clusters[current].append(line)
+    return (lines[0], clusters)
+
+
+class PlacementPlanner:
+  """Checks that a site can fit a virtual cluster before it is launched
+
+  A cluster of num_cpus compute nodes and a frontend is booted as
+  num_cpus + 1 single core VMs that split the reserved memory evenly.  The
+  nodes are packed best-fit, largest first, into the site's free Condor
+  slots, or into the free capacity of its resource in the vc-manager.py
+  registry if Condor has no slots for it.  A cluster that fits is placed,
+  one that would only fit once busy slots are free is deferred until a later
+  sweep, and one that is bigger than the whole site is rejected: its site is
+  stopped in Booked with the reason as its admin notes, which are emailed to
+  the owner.  All of this happens before the DAG is written or any ssh or
+  scp is started.
+  """
+
+  PLACE = "placed"
+  DEFER = "deferred"
+  REJECT = "rejected"
+
+  def plan(self, site, site_desc):
+    """Decide whether to launch a site's virtual cluster now
+
+      Args:
+        site(dict): details of reservation site
+        site_desc(dict): Booked description of the site
+
+      Returns:
+        tuple: (PLACE, DEFER or REJECT, string explaining the decision)
+    """
+    hostname = site_desc['site_hostname']
+    nodes = [(1, node_memory(site['memory'], site['CPU']))] * (
+      int(site['CPU']) + 1)
+    capacity = self.capacity(hostname)
+    if capacity is None:
+      return PlacementPlanner.PLACE, "no capacity known for %s" % hostname
+    (free, total) = capacity
+    demand = "%d cores, %d MB" % (len(nodes), sum([n[1] for n in nodes]))
+    if self.pack(nodes, free):
+      return PlacementPlanner.PLACE, "%s fits on %s" % (demand, hostname)
+    if self.pack(nodes, total):
+      return PlacementPlanner.DEFER, "%s not yet free on %s" % (
+        demand, hostname)
+    return PlacementPlanner.REJECT, "%s is more than %s has" % (
+      demand, hostname)
+
+  def capacity(self, hostname):
+    """Return ([free bins], [all bins]) of (cores, memory MB) on hostname,
+    or None if unknown"""
+    try:
+      slots = [slot for (name, slot) in condor_module.iter_slots(hostname)]
+    except (IOError, OSError) as e:
+      logging.debug("  Unable to query Condor slots of %s: %s" % (hostname, e))
+      slots = []
+    if slots:
+      return ([(s['Cpus'], s['Memory']) for s in slots
+               if s['State'] == "Unclaimed"],
+              [(s['Cpus'], s['Memory']) for s in slots])
+    try:
+      registry = getRegistry()
+      if registry is None:
+        return None
+      try:
+        resources = registry.hosted(hostname)
+      finally:
+        registry.close()
+    except (IOError, OSError, sqlite3.Error) as e:
+      logging.debug("  Unable to read resource registry: %s" % e)
+      resources = []
+    if resources:
+      return ([(r['cores'] - r['used_cores'], r['memory'] - r['used_memory'])
+               for r in resources],
+              [(r['cores'], r['memory']) for r in resources])
+    return None
+
+  def pack(self, nodes, bins):
+    """Return True if all nodes of (cores, memory) fit into bins, placing
+    the largest node first into the bin it leaves the least room in"""
+    bins = list(bins)
+    for (cores, memory) in sorted(nodes, key=lambda n: (n[1], n[0]),
+                                  reverse=True):
+      fits = [i for i in range(len(bins))
+              if bins[i][0] >= cores and bins[i][1] >= memory]
+      if not fits:
+        return False
+      best = min(fits, key=lambda i: (bins[i][1] - memory, bins[i][0] - cores))
+      bins[best] = (bins[best][0] - cores, bins[best][1] - memory)
+    return True
+
+
+class NodeSpec(object):
+  """Settings of one DAG node read from its vc<id>.sub and vc<id>.vmconf
+
+  Both files are parsed in a single pass each with precompiled patterns.
+  Parsed nodes are cached by path and reused until either file's
+  modification time changes.
+  """
+
+  __slots__ = ["sub_file", "vcdir", "hostname", "username", "var_run",
+               "pragma_boot_path", "python_path", "pragma_boot_version",
+               "memory", "args", "mtimes"]
+
+  JOB_PATTERN = re.compile(r".*\s(\S+)$")
+  SUB_PATTERN = re.compile(r"^\s*(\w+)\s*=\s*(.*?)\s*$")
+  MACHINE_PATTERN = re.compile(r'Machine\s*==\s*"([^"]+)"')
+  VMCONF_PATTERN = re.compile(r"^--(\S+)\s+=\s+(\S+)")
+
+  cache = {}
+  cache_lock = threading.Lock()
+
+  @classmethod
+  def for_dag(cls, dag_dir, site_id=None):
+    """Return a NodeSpec for each node listed in the DAG's dag.sub, or only
+    for the node of site_id if given"""
+    nodes = []
+    subf = open(os.path.join(dag_dir, 'dag.sub'), 'r')
+    for line in subf:
+      matched = cls.JOB_PATTERN.match(line)
+      if matched and (site_id is None or os.path.basename(
+          matched.group(1)) == "vc%s.sub" % site_id):
+        nodes.append(cls.load(matched.group(1)))
+    subf.close()
+    return nodes
+
+  @classmethod
+  def load(cls, sub_file):
+    """Return the NodeSpec for sub_file, parsing it only if it changed"""
+    mtimes = cls._mtimes(sub_file)
+    with cls.cache_lock:
+      node = cls.cache.get(sub_file)
+    if node is None or node.mtimes != mtimes:
+      node = NodeSpec(sub_file)
+      with cls.cache_lock:
+        cls.cache[sub_file] = node
+    return node
+
+  @staticmethod
+  def _mtimes(sub_file):
+    vmconf_file = sub_file.replace('.sub', '.vmconf')
+    return (os.path.getmtime(sub_file),
+            os.path.exists(vmconf_file) and os.path.getmtime(vmconf_file))
+
+  def __init__(self, sub_file):
+    self.sub_file = sub_file
+    self.vcdir = os.path.dirname(sub_file)
+    self.mtimes = NodeSpec._mtimes(sub_file)
+    attrs = {}
+    f = open(sub_file, "r")
+    for line in f:
+      matched = NodeSpec.SUB_PATTERN.match(line)
+      if matched:
+        attrs[matched.group(1)] = matched.group(2)
     f.close()
-    return (result, stdout_text)
+    matched = NodeSpec.MACHINE_PATTERN.search(attrs.get("requirements", ""))
+    self.hostname = matched.group(1) if matched else None
+    self.username = attrs.get("username")
+    self.var_run = attrs.get("var_run")
+    self.pragma_boot_path = attrs.get("pragma_boot_path")
+    self.python_path = attrs.get("python_path", "")
+    self.pragma_boot_version = attrs.get("pragma_boot_version")
+    self.memory = attrs.get("RequestMemory")
+
+    self.args = {}
+    vmconf_file = sub_file.replace('.sub', '.vmconf')
+    if os.path.exists(vmconf_file):
+      f = open(vmconf_file, "r")
+      for line in f:
+        matched = NodeSpec.VMCONF_PATTERN.match(line)
+        if matched:
+          self.args[matched.group(1)] = matched.group(2)
+      f.close()
 
 
+class Dag:
+
+  def __init__(self, dag_dir, reservation_id):
+    self.dag_dir = os.path.join(dag_dir, "dag-%s" % reservation_id)
+    self.reservation_id = reservation_id
+
   def write(self, reservation, user, site, site_desc):
     """Write a Condor DAG to localdisk
 
@@ -345,32 +1255,28 @@ class Dag:
         string: path to the dir where dag was written
     """
     # make dag dir and write user's key to disk
+    sshKeyPath = os.path.join(self.dag_dir, "public_key")
     if not os.path.exists(self.dag_dir):
       logging.debug("  Creating dag directory " + self.dag_dir)
       os.makedirs(self.dag_dir)
       rf = open('/root/.ssh/id_rsa.pub', 'r')
       root_key = rf.read()
       rf.close()
-      sshKeyPath = os.path.join(self.dag_dir, "public_key")
       f = open(sshKeyPath, 'w')
       logging.debug("  Writing file " + f.name)
       f.write(user['public_key'] + "\n")
       f.write("%s\n" % root_key)
       f.close()
 
-    # write dag file
-    dag_f = open(os.path.join(self.dag_dir, "dag.sub"), 'w')
-    logging.debug("  Writing file " + dag_f.name)
-
     # create dag node files for each resource in reervation
     dagNodeDir = os.path.join(self.dag_dir, "vc%s" % site["site_id"])
+    subFile = os.path.join(dagNodeDir, "vc%s.sub" % site["site_id"])
     if not os.path.exists(dagNodeDir):
       logging.debug("  Creating dag node directory " + dagNodeDir)
       os.mkdir(dagNodeDir)
       # get resource info
-      f = open(os.path.join(dagNodeDir, "vc%s.sub" % site["site_id"]), 'w')
+      f = open(subFile, 'w')
       logging.debug("  Writing file " + f.name)
-      dag_f.write(" JOB VC%s  %s\n" % (site["site_id"], f.name))
       s = Template(NODE_TEMPLATE)
       # optional params
       python_path = "" if site_desc['python_path'] is None else site_desc[
@@ -391,258 +1297,690 @@ class Dag:
                            jobid=os.getpid(), mem=site['memory']))
       f.close()
 
-    # close out dag file
+    # write dag file listing the nodes of every site written so far, as
+    # sites of a reservation are written one at a time
+    dag_f = open(os.path.join(self.dag_dir, "dag.sub"), 'w')
+    logging.debug("  Writing file " + dag_f.name)
+    for name in sorted(os.listdir(self.dag_dir)):
+      nodeSubFile = os.path.join(self.dag_dir, name, "%s.sub" % name)
+      if name.startswith("vc") and os.path.exists(nodeSubFile):
+        dag_f.write(" JOB VC%s  %s\n" % (name[2:], nodeSubFile))
     dag_f.close()
 
   def is_running(self):
     """Check to see if dag is running
 
-      Args:
-        dagDir(string): Path to directory to store Condor DAGs
+      The cluster status of every site is fetched in parallel and then the
+      SSH ports of all public IPs found are probed together.
 
       Returns:
-        bool: True if dag is running, False otherwise.
+        string: login info if all clusters are running, None otherwise.
     """
-    (active, inactive, resourceinfo, frontendFqdn) = ([], [], "", "")
-    subf = open(os.path.join(self.dag_dir, 'dag.sub'), 'r')
-    for line in subf:
-      matched = re.match(".*\s(\S+)$", line)
-      if matched:
-        vcdir = os.path.dirname(matched.group(1))
-        hostname = getRegexFromFile(os.path.join(vcdir, "hostname"), "(.*)")
-        [conf] = glob.glob(os.path.join(vcdir, "*.sub"))
-        username = getRegexFromFile(conf, "username\s*=\s*(.*)")
-        var_run = getRegexFromFile(conf, "var_run\s*=\s*(.*)")
-        pragma_boot_path = getRegexFromFile(conf, "pragma_boot_path\s*=\s*(.*)")
-        python_path = getRegexFromFile(conf, "python_path\s*=\s*?(\S*?)$")
-        pragma_boot_version = getRegexFromFile(conf,
-                                               "pragma_boot_version\s*=\s*(.*)")
-        remote_dag_dir = os.path.join(var_run, "dag-%s" % self.reservation_id)
-        if pragma_boot_version == "2":
-          scp = 'scp %s@%s:%s %s >& /dev/null' % (
-            username, hostname, os.path.join(remote_dag_dir, "pragma_boot.log"),
-            vcdir)
-          logging.debug("  %s" % scp)
-          subprocess.call(scp, shell=True)
-          frontend = getRegexFromFile(
-            os.path.join(vcdir, "pragma_boot.log"), 'Allocated cluster (\S+)')
-          if not frontend:
-            frontend = getRegexFromFile(os.path.join(vcdir, "pragma_boot.log"),
-                                        'Successfully deployed frontend (\S+)')
-          ssh = 'ssh %s@%s %s %s/bin/pragma list cluster %s' % (
-            username, hostname, python_path, pragma_boot_path, frontend)
-          pragma_status_filename = os.path.join(vcdir, "pragma_list_cluster")
-          stdout_f = open(pragma_status_filename, "w")
-          logging.debug("  %s" % ssh)
-          result = subprocess.call(ssh, stdout=stdout_f, shell=True)
-          stdout_f.close()
-          f = open(pragma_status_filename, "r")
-          status = f.readlines()
-          f.close()
-          status.pop(0)  # discard header
-          isRunning = True
-          runningMatcher = re.compile("Running|active")
-          ipMatcher = re.compile("([\d\.]+)\s*$")
-          publicIP = None
-          for line in status:
-            if not runningMatcher.search(line):
-              isRunning = False
-            else:
-              matched = ipMatcher.search(line)
-              if matched:
-                publicIP = matched.group(1)
-          accessible = False
-          if publicIP:
-            logging.info("   Found public IP %s" % publicIP)
-            ssh = 'echo | nc -w 30 %s 22 2>&1 | grep SSH > /dev/null 2>&1' % (
-              publicIP)
-            result = subprocess.call(ssh, shell=True)
-            if result == 0:
-              logging.info("   SSH is active on %s" % publicIP)
-              accessible = True
-            else:
-              logging.info("   SSH is not yet active on %s" % publicIP)
-          if isRunning and accessible:
-            active.append(frontend)
-          else:
-            inactive.append(frontend)
-          logging.info("   %s" % status)
+    (active, inactive, publicIP) = ([], [], None)
+    nodes = NodeSpec.for_dag(self.dag_dir)
+    sites = WorkerPool(len(nodes)).map(self._cluster_status, nodes)
+    accessible = SSHProbe.get().check(
+      [site['publicIP'] for site in sites if site and site['publicIP']])
+    for site in sites:
+      if site is None:
+        inactive.append(None)
+        continue
+      if site['publicIP']:
+        publicIP = site['publicIP']
+        if accessible.get(publicIP):
+          logging.info("   SSH is active on %s" % publicIP)
         else:
-          logging.error(
-            "Error, unknown or unsupported pragma_boot version %s" % pragma_boot_version)
-          sys.exit(1)
+          logging.info("   SSH is not yet active on %s" % publicIP)
+      if site['isRunning'] and accessible.get(site['publicIP']):
+        active.append(site['frontend'])
+      else:
+        inactive.append(site['frontend'])
     logging.info("   Active clusters: %s" % str(active))
     logging.info("   Inactive clusters: %s" % str(inactive))
-    subf.close()
     if len(inactive) == 0:
       s = Template(LOGIN_INFO)
       return s.substitute(fqdn=publicIP)
     return None
 
+  def _cluster_status(self, node):
+    """Get the pragma_boot status of the cluster launched for node
 
-  def start(self):
-    """Start the dag using pragma_boot directly via SSH
+      Args:
+        node(NodeSpec): DAG node to check
+
+      Returns:
+        dict: frontend, isRunning and publicIP; None if unknown version
+    """
+    vcdir = node.vcdir
+    remote_dag_dir = os.path.join(node.var_run, "dag-%s" % self.reservation_id)
+    if node.pragma_boot_version != "2":
+      logging.error(
+        "Error, unknown or unsupported pragma_boot version %s" % node.pragma_boot_version)
+      return None
+    shell = RemoteShell.get(node.username, node.hostname)
+    progress = self._boot_progress(
+      shell, os.path.join(remote_dag_dir, "pragma_boot.log"),
+      os.path.join(vcdir, "pragma_boot.log"))
+    frontend = progress.summary["frontend"]
+    if progress.summary["prepare_secs"] is not None:
+      callIndex(
+        "record_prepare", self.reservation_id,
+        os.path.basename(vcdir).replace("vc", "", 1),
+        progress.summary["prepare_secs"])
+    status = ClusterList.get().lines(node, frontend)
+    writeStringToFile(
+      os.path.join(vcdir, "pragma_list_cluster"), "".join(status))
+    status = status[1:]  # discard header
+    isRunning = True
+    runningMatcher = re.compile("Running|active")
+    ipMatcher = re.compile("([\d\.]+)\s*$")
+    publicIP = None
+    for line in status:
+      if not runningMatcher.search(line):
+        isRunning = False
+      else:
+        matched = ipMatcher.search(line)
+        if matched:
+          publicIP = matched.group(1)
+    if publicIP:
+      logging.info("   Found public IP %s" % publicIP)
+    logging.info("   %s" % status)
+    callIndex(
+      "update", getIndexPool(), self.reservation_id,
+      os.path.basename(vcdir).replace("vc", "", 1),
+      cluster=frontend or None, public_ip=publicIP, hostname=node.hostname)
+    return {'frontend': frontend, 'isRunning': isRunning,
+            'publicIP': publicIP}
+
+  def _boot_progress(self, shell, remote_log, local_log):
+    """Fetch what has been appended to the remote pragma_boot.log since the
+    last poll, add it to the local copy and parse only the new bytes
+
+      Args:
+        shell(RemoteShell): connection to the host running pragma_boot
+        remote_log(string): path to pragma_boot.log on the host
+        local_log(string): path to the local copy of pragma_boot.log
 
       Returns:
-        bool: True if writes successful, False otherwise.
+        BootProgress: progress of the launch so far
     """
+    progress = boot_progress.BootProgress.load(local_log)
+    if not os.path.exists(local_log):
+      progress.reset()
+    (result, output) = shell.run("wc -c < %s && tail -c +%d %s" % (
+      remote_log, progress.offset + 1, remote_log))
+    if result != 0:
+      logging.debug("   Unable to read %s" % remote_log)
+      return progress
+    (size, data) = output.split("\n", 1)
+    if int(size) < progress.offset:
+      # the log was started again, e.g. by a relaunch
+      progress.reset()
+      data = shell.run("cat %s" % remote_log)[1]
+      mode = "wb"
+    else:
+      mode = "ab"
+    f = open(local_log, mode)
+    f.write(data)
+    f.close()
+    progress.feed(data)
+    progress.save()
+    summary = progress.as_dict()
+    logging.debug("   Boot %s: %d%% %s (%d bytes new)" % (
+      summary["phase"], summary["percent"], summary["description"],
+      len(data)))
+    return progress
+
+  def _launches(self, site_id=None):
+    """Return the LaunchExecutor launch of each DAG node, or of only the
+    node of site_id if given, or None if a node has a pragma_boot version
+    that can not be launched"""
     local_hostname = socket.gethostname()
-    subf = open(os.path.join(self.dag_dir, 'dag.sub'), 'r')
-    for line in subf:
-      matched = re.match(".*\s(\S+)$", line)
-      if matched:
-        vcfile = matched.group(1)
-        hostname = getRegexFromFile(vcfile, 'Machine =="([^"]+)"')
-        username = getRegexFromFile(vcfile, "username\s*=\s*(.*)")
-        pragma_boot_path = getRegexFromFile(vcfile,
-                                            "pragma_boot_path\s*=\s*(\S+)")
-        python_path = getRegexFromFile(vcfile, "python_path\s*=\s*?(\S*?)$")
-        pragma_boot_version = getRegexFromFile(vcfile,
-                                               "pragma_boot_version\s*=\s*(\S+)")
-        var_run = getRegexFromFile(vcfile, "var_run\s*=\s*(\S+)")
-        remote_dag_dir = os.path.join(var_run, "dag-%s" % self.reservation_id)
-
-        host_f = open(os.path.join(os.path.dirname(vcfile), "hostname"), 'w')
-        host_f.write(hostname)
-        host_f.close()
-        if hostname != local_hostname:
-          logging.debug(
-            "  Copying dir %s over to %s:%s " % (self.dag_dir, hostname, remote_dag_dir))
-          subprocess.call('ssh %s@%s mkdir -p %s' % (username, hostname, var_run),
-                          shell=True)
-          subprocess.call('scp -r %s %s@%s:%s >& /dev/null' % (
-            self.dag_dir, username, hostname, remote_dag_dir), shell=True)
-        vmconf_file = vcfile.replace('.sub', '.vmconf')
-        vmf = open(vmconf_file, 'r')
-        if pragma_boot_version == "2":
-          args = {}
-          for line in vmf:
-            matched = re.match("--(\S+)\s+=\s+(\S+)", line)
-            args[matched.group(1)] = matched.group(2)
-          # pragma_boot takes memory per node so divide memory by num nodes (computes + frontend)
-          mem_per_node = 1024 * round(int(args["mem"]) / (int(args["num_cpus"]) + 1.0))
-          args["key"] = args["key"].replace(self.dag_dir, remote_dag_dir)
-          args["logfile"] = args["logfile"].replace(self.dag_dir, remote_dag_dir)
-          cmdline = "ssh -f %s@%s 'cd %s; %s %s/bin/pragma boot %s %s key=%s loglevel=DEBUG logfile=%s mem=%i' >& %s/ssh.out" % (
-            username, hostname, remote_dag_dir, python_path, pragma_boot_path,
-            args["vcname"], args["num_cpus"], args["key"], args["logfile"],
-            mem_per_node, self.dag_dir)
-        else:
-          logging.error(
-            "Error, unknown or unsupported pragma_boot version %s" % pragma_boot_version)
-          sys.exit(1)
-        logging.debug("  Running pragma_boot: %s" % cmdline)
-        subprocess.call(cmdline, shell=True)
-    subf.close()
-    logging.debug("  Sleeping 10 seconds")
-    time.sleep(10)
+    launches = []
+    for node in NodeSpec.for_dag(self.dag_dir, site_id):
+      remote_dag_dir = os.path.join(node.var_run, "dag-%s" % self.reservation_id)
+      writeStringToFile(os.path.join(node.vcdir, "hostname"), node.hostname)
+      launch = {'hostname': node.hostname, 'username': node.username,
+                'remote_dag_dir': remote_dag_dir,
+                'vcdir': node.vcdir, 'copy': node.hostname != local_hostname}
+      if node.pragma_boot_version == "2":
+        args = dict(node.args)
+        # pragma_boot takes memory per node so divide memory by num nodes (computes + frontend)
+        mem_per_node = node_memory(args["mem"], args["num_cpus"])
+        args["key"] = args["key"].replace(self.dag_dir, remote_dag_dir)
+        args["logfile"] = args["logfile"].replace(self.dag_dir, remote_dag_dir)
+        pragma = "%s %s/bin/pragma" % (node.python_path, node.pragma_boot_path)
+        launch['logfile'] = args["logfile"]
+        launch['vcname'] = args["vcname"]
+        launch['cores'] = int(args["num_cpus"]) + 1
+        launch['memory'] = int(launch['cores'] * mem_per_node)
+        launch['pragma'] = pragma
+        launch['check'] = "cd %s && %s list repository" % (
+          remote_dag_dir, pragma)
+        launch['cmdline'] = "cd %s; %s boot %s %s key=%s loglevel=DEBUG logfile=%s mem=%i" % (
+          remote_dag_dir, pragma, args["vcname"], args["num_cpus"],
+          args["key"], args["logfile"], mem_per_node)
+      else:
+        logging.error(
+          "Error, unknown or unsupported pragma_boot version %s" % node.pragma_boot_version)
+        return None
+      launches.append(launch)
+    return launches
+
+  def _executor(self):
+    return LaunchExecutor(
+      self.dag_dir,
+      int(getConfigOption(config, "Launch", "perHostConcurrency", 2)),
+      int(getConfigOption(config, "Launch", "confirmTimeout", 120)))
+
+  def stage(self, site_id):
+    """Copy the dag node of a site to its host and check the host is ready
+    to boot it, ahead of the reservation's start
+
+      Args:
+        site_id(string): id of the site whose node to stage
+
+      Returns:
+        bool: True if the node is staged and ready, False otherwise.
+    """
+    launches = self._launches(site_id)
+    if not launches:
+      return False
+    staged = all(self._executor().run(launches, stage_only=True))
+    if staged:
+      writeStringToFile(os.path.join(launches[0]['vcdir'], "staged"),
+                        datetime.utcnow().strftime(ISO_FORMAT))
+    return staged
+
+  def is_staged(self, site_id):
+    """Return True if the dag node of a site has been staged successfully"""
+    return os.path.exists(
+      os.path.join(self.dag_dir, "vc%s" % site_id, "staged"))
+
+  def start(self, site_id):
+    """Start the dag node of a site using pragma_boot directly via SSH
+
+      The copy and boot steps are run by a LaunchExecutor, which confirms
+      the launch instead of sleeping.  A node already staged only needs the
+      boot step, as its copy is up to date, and reuses whether its image was
+      warm when staged.  Each site is started by its own handler, so the
+      nodes of other sites are left alone.
+
+      Args:
+        site_id(string): id of the site whose node to start
+
+      Returns:
+        bool: True if the launch was accepted, False otherwise.
+    """
+    launches = self._launches(site_id)
+    if launches is None:
+      return False
+    for launch in launches:
+      warm = self._image_warm(launch)
+      logging.info("  Image %s is %s on %s" % (
+        launch['vcname'], "warm" if warm else "cold", launch['hostname']))
+      callIndex(
+        "record_launch", self.reservation_id,
+        os.path.basename(launch['vcdir']).replace("vc", "", 1),
+        launch['hostname'], launch['vcname'], warm)
+    accepted = self._executor().run(launches)
+    for (launch, ok) in zip(launches, accepted):
+      if ok:
+        self._claim(launch)
+    return all(accepted)
+
+  def _image_warm(self, launch):
+    """Return True if the launch's image was staged at its host when the
+    dag was staged, only asking the host if the dag was never staged"""
+    try:
+      f = open(os.path.join(launch['vcdir'], "image"))
+      try:
+        return f.read().strip() == "warm"
+      finally:
+        f.close()
+    except IOError:
+      return ImageInventory.get().has(launch['username'], launch['hostname'],
+                                      launch['pragma'], launch['vcname'])
+
+  def _claim(self, launch):
+    """Count the cores and memory of an accepted launch as in use on its
+    host's resource in the registry, once however often it is retried"""
+    claim_file = os.path.join(launch['vcdir'], "claim")
+    if os.path.exists(claim_file):
+      return
+    try:
+      registry = getRegistry()
+      if registry is None:
+        return
+      try:
+        resources = registry.hosted(launch['hostname'])
+        free = [r for r in resources
+                if r['cores'] - r['used_cores'] >= launch['cores'] and
+                r['memory'] - r['used_memory'] >= launch['memory']]
+        if not free:
+          if resources:
+            logging.warning("  No resource on %s has %d cores and %d MB free "
+                            "to claim" % (launch['hostname'], launch['cores'],
+                                          launch['memory']))
+          return
+        claim = {"pool": free[0]['pool'], "name": free[0]['name'],
+                 "cores": launch['cores'], "memory": launch['memory']}
+        registry.use(claim['pool'], claim['name'], claim['cores'],
+                     claim['memory'])
+      finally:
+        registry.close()
+    except (IOError, OSError, sqlite3.Error, vc_registry.RegistryError) as e:
+      logging.warning("  Unable to claim resource on %s: %s" % (
+        launch['hostname'], e))
+      return
+    writeStringToFile(claim_file, json.dumps(claim))
+
+  def _release(self, vcdir):
+    """Release the cores and memory claimed for a site's launch, if any"""
+    claim_file = os.path.join(vcdir, "claim")
+    try:
+      claim = json.load(open(claim_file))
+    except (IOError, ValueError):
+      return True
+    try:
+      registry = getRegistry()
+      if registry is not None:
+        try:
+          registry.use(claim['pool'], claim['name'], -claim['cores'],
+                       -claim['memory'])
+        finally:
+          registry.close()
+    except vc_registry.RegistryError as e:
+      # e.g. the resource was removed from its pool since it was claimed
+      logging.warning("  Dropping claim on %s: %s" % (claim['name'], e))
+    except (IOError, OSError, sqlite3.Error) as e:
+      logging.error("  Unable to release resource %s: %s" % (claim['name'], e))
+      return False
+    os.remove(claim_file)
     return True
 
   def stop(self):
     """Stop the dag using pragma_boot directly via SSH
 
+      The clusters of all sites are shut down and cleaned at the same time,
+      each with its own timeout, and a site that fails does not stop the
+      others.  The outcome of each step is recorded in the site's vc
+      directory so later calls only retry the steps that have not succeeded.
+
       Returns:
-        bool: True if writes successful, False otherwise.
+        bool: True if all sites are shut down and cleaned, False otherwise.
     """
-    local_hostname = socket.gethostname()
-    subf = open(os.path.join(self.dag_dir, 'dag.sub'), 'r')
-    for line in subf:
-      matched = re.match(".*\s(\S+)$", line)
-      if matched:
-        vcfile = matched.group(1)
-        vcdir = os.path.dirname(matched.group(1))
-        hostname = getRegexFromFile(vcfile, 'Machine =="([^"]+)"')
-        username = getRegexFromFile(vcfile, "username\s*=\s*(.*)")
-        pragma_boot_path = getRegexFromFile(vcfile,
-                                            "pragma_boot_path\s*=\s*(\S+)")
-        python_path = getRegexFromFile(vcfile, "python_path\s*=\s*?(\S*?)$")
-        frontend = getRegexFromFile(os.path.join(vcdir, "pragma_boot.log"),
-                                    'Allocated cluster (\S+)')
-        ssh_pragma = "ssh %s@%s %s %s/bin/pragma" % (
-          username, hostname, python_path, pragma_boot_path)
-        shutdown_cmd = "%s shutdown %s" % (ssh_pragma, frontend)
-        logger.debug("  Shutting down %s: %s" % (frontend, shutdown_cmd))
-        (result, stdout_text) = self._run_shell_command(
-          shutdown_cmd, os.path.join(vcdir, "pragma_shutdown"))
-        if result != 0:
-          logger.error("  Error shutting down virtual cluster %s" % frontend)
-          return False
-        logger.debug("  %s" % stdout_text)
-        clean_cmd = "%s clean %s" % (ssh_pragma, frontend)
-        logger.debug("  Cleaning %s: %s" % (frontend, clean_cmd))
-        (result, stdout_text) = self._run_shell_command(
-          clean_cmd, os.path.join(vcdir, "pragma_clean"))
-        logger.debug("  %s" % stdout_text)
-        if result != 0:
-          logger.error("  Error cleaning virtual cluster %s" % frontend)
+    nodes = NodeSpec.for_dag(self.dag_dir)
+    timeout = int(getConfigOption(config, "Stopping", "siteTimeout", 600))
+    outcomes = WorkerPool(len(nodes)).map(
+      lambda node: self._teardown(node, timeout), nodes)
+    failed = [node.hostname for (node, done) in zip(nodes, outcomes)
+              if not done]
+    if failed:
+      logging.error("  Teardown incomplete on %s; will retry on next sweep" %
+                    ", ".join(failed))
+    return not failed
+
+  def _teardown(self, node, timeout):
+    """Shut down and clean the cluster of one site
+
+      Args:
+        node(NodeSpec): DAG node of the site
+        timeout(int): max secs for each of shutdown and clean
+
+      Returns:
+        bool: True if the cluster is shut down and cleaned, False otherwise.
+    """
+    outcome_file = os.path.join(node.vcdir, "teardown")
+    try:
+      outcome = json.load(open(outcome_file))
+    except (IOError, ValueError):
+      outcome = {}
+    shell = RemoteShell.get(node.username, node.hostname)
+    frontend = outcome.get("frontend")
+    if not frontend:
+      # catch up on the log in case the cluster was allocated since last polled
+      frontend = self._boot_progress(
+        shell, os.path.join(node.var_run, "dag-%s" % self.reservation_id,
+                            "pragma_boot.log"),
+        os.path.join(node.vcdir, "pragma_boot.log")).summary["frontend"]
+      outcome["frontend"] = frontend
+    if not frontend:
+      logging.warning("  No cluster was allocated on %s; nothing to stop" %
+                      node.hostname)
+      return self._release(node.vcdir)
+    pragma = "%s %s/bin/pragma" % (node.python_path, node.pragma_boot_path)
+    for step in ["shutdown", "clean"]:
+      if outcome.get(step, {}).get("ok"):
+        continue
+      cmd = "%s %s %s" % (pragma, step, frontend)
+      logging.debug("  Running %s of %s: %s" % (step, frontend, cmd))
+      start = time.time()
+      (result, stdout_text) = shell.run(cmd, timeout=timeout)
+      logging.debug("  %s" % stdout_text)
+      outcome[step] = {"ok": result == 0, "exit": result,
+                       "secs": round(time.time() - start, 2),
+                       "time": time.time()}
+      writeStringToFile(outcome_file, json.dumps(outcome))
+      if result != 0:
+        logging.error("  Error in %s of virtual cluster %s on %s (exit %d)" % (
+          step, frontend, node.hostname, result))
+        return False
+    return self._release(node.vcdir)
+
+
+class LaunchExecutor:
+  """Runs the copy and pragma_boot steps of DAG nodes in parallel
+
+  Nodes are launched in their own threads, with at most per_host launches
+  talking to the same host at a time across all executors, so reservations
+  launched in parallel share the limit.  A launch counts as accepted once the
+  pragma_boot log file shows up on the remote host; it fails if ssh exits
+  with an error, writes an error to ssh.out or no log shows up within
+  confirm_timeout.  A retried launch whose earlier boot did create the log
+  is accepted without booting again.  The time taken by each phase is logged
+  per host.
+  """
+
+  PHASES = ["sync", "check", "boot", "confirm"]
+
+  # files in a vc directory that are written locally and never sent
+  LOCAL_ONLY_FILES = ["hostname", "ssh.out", "pragma_boot.log",
+                      "pragma_boot.log.progress", "pragma_list_cluster",
+                      "teardown", "claim", "image", "staged"]
+
+  host_locks = {}
+  host_locks_lock = threading.Lock()
+
+  def __init__(self, dag_dir, per_host, confirm_timeout):
+    self.dag_dir = dag_dir
+    self.per_host = per_host
+    self.confirm_timeout = confirm_timeout
+
+  def _host_lock(self, hostname):
+    """Return the semaphore limiting launches to hostname"""
+    with LaunchExecutor.host_locks_lock:
+      if hostname not in LaunchExecutor.host_locks:
+        LaunchExecutor.host_locks[hostname] = threading.BoundedSemaphore(
+          self.per_host)
+      return LaunchExecutor.host_locks[hostname]
+
+  def run(self, launches, stage_only=False):
+    """Launch all nodes
+
+      Args:
+        launches(list): dict per node with hostname, username,
+          remote_dag_dir, vcdir, copy, logfile, vcname, check and cmdline
+        stage_only(bool): only copy the DAG and check the hosts are ready
+
+      Returns:
+        list: True for each launch that was accepted (or staged), False
+          otherwise
+    """
+    return WorkerPool(len(launches)).map(
+      lambda node: self.launch(node, stage_only), launches)
+
+  def launch(self, node, stage_only=False):
+    timings = {}
+    with self._host_lock(node['hostname']):
+      shell = RemoteShell.get(node['username'], node['hostname'])
+      if node['copy']:
+        logging.debug("  Syncing dir %s over to %s:%s " % (
+          node['vcdir'], node['hostname'], node['remote_dag_dir']))
+        if self._timed(timings, "sync", self.sync, shell, node) != 0:
+          logging.error("  Unable to copy DAG to %s" % node['hostname'])
           return False
+      if stage_only:
+        accepted = self._timed(timings, "check", self.check, shell, node)
+      elif os.path.exists(os.path.join(node['vcdir'], "ssh.out")) and \
+          shell.run("test -e %s" % node['logfile'])[0] == 0:
+        # an earlier, unconfirmed boot got going after all
+        logging.info("  pragma_boot already started on %s" % node['hostname'])
+        accepted = True
+      else:
+        logging.debug("  Running pragma_boot: %s" % node['cmdline'])
+        result = self._timed(timings, "boot", shell.run_background,
+                             node['cmdline'],
+                             os.path.join(node['vcdir'], "ssh.out"))
+        accepted = result == 0 and self._confirm(timings, node, shell)
+    logging.info("  %s on %s %s: %s" % (
+      "Staging" if stage_only else "Launch", node['hostname'],
+      "accepted" if accepted else "failed",
+      ", ".join(["%s %.1fs" % (phase, timings[phase])
+                 for phase in LaunchExecutor.PHASES if phase in timings])))
+    return accepted
+
+  def check(self, shell, node):
+    """Check pragma_boot runs on the node's host and note whether it has
+    its image; a host without it is still ready, as pragma_boot fetches the
+    image (cold) when it boots
+
+      Returns:
+        bool: True if the host is ready to boot the node, False otherwise
+    """
+    (result, stdout_text) = shell.run(node['check'])
+    if result != 0:
+      logging.error("  pragma_boot is not ready on %s" % node['hostname'])
+      return False
+    images = ImageInventory.parse_repository(stdout_text)
+    ImageInventory.get().update(node['hostname'], images)
+    warm = node['vcname'] in images
+    if not warm:
+      logging.info("  Image %s is not yet in the repository on %s; it will "
+                   "be fetched cold at boot" % (
+                     node['vcname'], node['hostname']))
+    # kept for Dag.start, so the boot need not ask the host again
+    writeStringToFile(os.path.join(node['vcdir'], "image"),
+                      "warm" if warm else "cold")
     return True
 
+  def sync(self, shell, node):
+    """Send the node its vc directory and the public key, if changed
 
-def getRegexFromFile(file, regex):
-  """Grab some strings from a file based on a regex
+      Files whose SHA-1 matches the copy already on the remote host are
+      skipped; the rest are sent together in one tar stream.
 
-    Args:
-      file(string): Path to file containing string
-      regex(string): Regex to parse from file
+      Returns:
+        int: 0 if successful, non-zero otherwise
+    """
+    vcname = os.path.basename(node['vcdir'])
+    paths = ["public_key"]
+    for filename in sorted(os.listdir(node['vcdir'])):
+      if filename not in LaunchExecutor.LOCAL_ONLY_FILES:
+        paths.append(os.path.join(vcname, filename))
+    (result, stdout_text) = shell.run("cd %s 2>/dev/null && sha1sum %s" % (
+      node['remote_dag_dir'], " ".join(paths)))
+    remote_hashes = {}
+    for line in stdout_text.splitlines():
+      fields = line.split()
+      if len(fields) == 2:
+        remote_hashes[fields[1]] = fields[0]
+    changed = []
+    for path in paths:
+      f = open(os.path.join(self.dag_dir, path), "rb")
+      digest = hashlib.sha1(f.read()).hexdigest()
+      f.close()
+      if remote_hashes.get(path) != digest:
+        changed.append(path)
+    if not changed:
+      logging.info("  DAG files on %s are up to date" % node['hostname'])
+      return 0
+    (result, sent) = shell.send_files(
+      self.dag_dir, changed, node['remote_dag_dir'])
+    logging.info("  Sent %d of %d files (%d bytes) to %s" % (
+      len(changed), len(paths), sent, node['hostname']))
+    return result
+
+  def _timed(self, timings, phase, func, *args):
+    start = time.time()
+    result = func(*args)
+    timings[phase] = time.time() - start
+    return result
+
+  def _confirm(self, timings, node, shell):
+    """Wait for pragma_boot to create its log file on the remote host"""
+    start = time.time()
+    check = "test -e %s" % node['logfile']
+    accepted = False
+    while time.time() - start < self.confirm_timeout:
+      ssh_out = os.path.join(node['vcdir'], "ssh.out")
+      if os.path.exists(ssh_out) and re.search(
+          "error|denied|not found", open(ssh_out).read(), re.IGNORECASE):
+        logging.error("  pragma_boot on %s failed: see %s" % (
+          node['hostname'], ssh_out))
+        break
+      if shell.run(check)[0] == 0:
+        accepted = True
+        break
+      time.sleep(2)
+    else:
+      # unconfirmed; the launch is retried on a later sweep, which accepts
+      # it if a slow boot has created the log by then
+      logging.warning("  No pragma_boot log on %s after %d secs" % (
+        node['hostname'], self.confirm_timeout))
+    timings["confirm"] = time.time() - start
+    return accepted
 
-    Returns:
-      list: Args returned from regex
+
+class StateStore:
+  """SQLite record of the last seen state of each reservation and site
+
+  Booked has no API to ask for only the reservations changed since the last
+  sweep, so each reservation record is hashed and compared to the hash
+  stored on the previous sweep.
   """
-  f = open(file, "r")
-  matcher = re.compile(regex, re.MULTILINE)
-  matched = matcher.search(f.read())
-  f.close()
-  if not matched:
-    return []
-  elif len(matched.groups()) == 1:
-    return matched.group(1)
-  else:
-    return matched.groups()
 
+  def __init__(self, filename):
+    # dagDir may be on a tmpfs that is empty after a reboot
+    if os.path.dirname(filename) and not os.path.isdir(
+        os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    self.db = sqlite3.connect(filename)
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS reservations (
+        reservation_id TEXT PRIMARY KEY,
+        hash TEXT,
+        modified REAL,
+        seen REAL);
+      CREATE TABLE IF NOT EXISTS sites (
+        reservation_id TEXT,
+        site_id TEXT,
+        status TEXT,
+        modified REAL,
+        PRIMARY KEY (reservation_id, site_id));
+    """)
+
+  @staticmethod
+  def hash(reservation):
+    return hashlib.sha1(json.dumps(reservation, sort_keys=True)).hexdigest()
+
+  def changed(self, reservation):
+    """Return True if reservation differs from when it was last recorded"""
+    row = self.db.execute(
+      "SELECT hash FROM reservations WHERE reservation_id = ?",
+      (str(reservation['reservation_id']),)).fetchone()
+    return row is None or row[0] != StateStore.hash(reservation)
+
+  def record(self, reservation):
+    """Save the hash of reservation and the status of each of its sites"""
+    now = time.time()
+    rid = str(reservation['reservation_id'])
+    digest = StateStore.hash(reservation)
+    with self.db:
+      row = self.db.execute(
+        "SELECT hash, modified FROM reservations WHERE reservation_id = ?",
+        (rid,)).fetchone()
+      modified = row[1] if row and row[0] == digest else now
+      self.db.execute(
+        "INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?)",
+        (rid, digest, modified, now))
+      for site in reservation['sites']:
+        row = self.db.execute(
+          "SELECT status, modified FROM sites "
+          "WHERE reservation_id = ? AND site_id = ?",
+          (rid, str(site['site_id']))).fetchone()
+        modified = row[1] if row and row[0] == site['status'] else now
+        self.db.execute(
+          "INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?)",
+          (rid, str(site['site_id']), site['status'], modified))
+
+  def close(self):
+    self.db.close()
+
+
+class WorkerPool:
+  """Bounded pool of worker threads
+
+  Runs a function over a list of items with at most size calls in flight.
+  A pool of size 1 runs everything in the calling thread, in order.
+  """
 
-def writeStringToFile(file, aString):
-  """Write a string to file
+  def __init__(self, size):
+    self.size = max(1, size)
 
-    Args:
-      file(string): Path to file containing string
-      aString(string): string to write to file
+  def map(self, func, items):
+    """Call func on each item
 
-    Returns:
-      bool: True if success otherwise false
-  """
-  f = open(file, 'w')
-  f.write(aString)
-  return f.close()
+      Exceptions raised by func are logged and its result for that item is
+      None, so one failing item does not stop the others.
 
-# main
+      Args:
+        func(function): function taking a single item
+        items(list): items to process
 
-# read input arguments from property file
-config = ConfigParser()
-config.read("cloud-scheduler.cfg");
+      Returns:
+        list: results of func in the same order as items
+    """
+    results = [None] * len(items)
+    if self.size == 1 or len(items) <= 1:
+      for i, item in enumerate(items):
+        results[i] = self._call(func, item)
+      return results
+
+    tasks = Queue()
+    for i, item in enumerate(items):
+      tasks.put((i, item))
+
+    def worker():
+      while True:
+        try:
+          (i, item) = tasks.get_nowait()
+        except Empty:
+          return
+        results[i] = self._call(func, item)
+
+    threads = []
+    for n in range(min(self.size, len(items))):
+      thread = threading.Thread(target=worker, name="worker-%d" % n)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+    return results
+
+  def _call(self, func, item):
+    try:
+      return func(item)
+    except Exception:
+      logging.exception("  Error in worker")
+      return None
 
-# configure logging 
-logger = logging.getLogger()
-logger.setLevel(config.get("Logging", "level"))
-handler = TimedRotatingFileHandler(config.get("Logging", "file"), when="W0",
-                                   interval=1, backupCount=5)
-handler.setFormatter(logging.Formatter(
-  "%(asctime)s - %(levelname)s - line %(lineno)d - %(message)s"))
-logger.addHandler(handler)
 
-client = GUIClient(config)
-client.authenticate()
+def process_reservation(reservation, client):
+  """Handle all sites of one reservation and email the owner any changes
 
-# Examine all reservations and determine which require actions
-logging.debug("Reading current and future reservations")
-data = client.query("pccGetAllReservations.py", "POST", None)
+    Sites of a reservation share one DAG directory and each status update
+    returns the new reservation record, so sites are handled in order.
 
-site_descriptions = {}
+    Args:
+      reservation(dict): reservation record from Booked
+      client(GUIClient): authenticated Booked client
 
-# Iterate thru unique reservations
-for reservation in data["result"]:
-  userparams = {'username': reservation['owner']}
-  userdata = client.query("getUserData.py", "POST", userparams)
+    Returns:
+      dict: reservation record after any status updates
+  """
+  userdata = client.query_user(reservation['owner'])
   res = Reservation(reservation, userdata, config.get("Server", "dagDir"), client)
 
   site_status_changes = {}
@@ -660,34 +1998,514 @@ for reservation in data["result"]:
       logging.exception("  Error processing reservation: %s" % res.reservation['reservation_id'])
 
   if site_status_changes:
-    s = Template(RESERVATION_TEMPLATE)
-    mailbody = s.substitute(userFirst=userdata['firstname'].capitalize(),
-                            reservation_id=reservation['reservation_id'],
-                            title=reservation['title'],
-                            description=reservation['description'],
-                            begin=reservation['begin'], end=reservation['end'],
-                            image=reservation['image_type'],
-                            numsites=len(reservation['sites']))
-    for site in reservation["sites"]:
-      notes = ""
-      if site['admin_description'] != 'None':
-        notes = "Admin notes: %s" % site['admin_description']
-      s = Template(SITE_TEMPLATE)
-      site_status = site_status_changes[site['site_id']]['was']
-      if site_status_changes[site['site_id']]['now']:
-        site_status = "%s (was %s)" % (
-          site_status_changes[site['site_id']]['now'],
-          site_status_changes[site['site_id']]['was'])
-      mailbody += s.substitute(siteName=site['site_name'], status=site_status,
-                               cpus=site['CPU'], memory=site['memory'],
-                               notes=notes)
-
-    msg = MIMEText(mailbody)
-    msg['Subject'] = 'Update: PRAGMA Cloud Scheduler reservation #%s' % \
-                     reservation['reservation_id']
-    msg['From'] = 'root@%s' % config.get("Server", "hostname")
-    msg['To'] = userdata['email_address']
-
-    s = smtplib.SMTP('localhost')
-    s.sendmail(msg['From'], [msg['To']], msg.as_string())
-    s.quit()
+    send_reservation_update(reservation, userdata, site_status_changes)
+  return reservation
+
+
+def send_reservation_update(reservation, userdata, site_status_changes):
+  """Email the reservation owner a summary of its site status changes
+
+    Args:
+      reservation(dict): reservation record from Booked
+      userdata(dict): owner record from Booked
+      site_status_changes(dict): site_id -> {'was': status, 'now': status}
+  """
+  s = Template(RESERVATION_TEMPLATE)
+  mailbody = s.substitute(userFirst=userdata['firstname'].capitalize(),
+                          reservation_id=reservation['reservation_id'],
+                          title=reservation['title'],
+                          description=reservation['description'],
+                          begin=reservation['begin'], end=reservation['end'],
+                          image=reservation['image_type'],
+                          numsites=len(reservation['sites']))
+  for site in reservation["sites"]:
+    notes = ""
+    if site['admin_description'] != 'None':
+      notes = "Admin notes: %s" % site['admin_description']
+    s = Template(SITE_TEMPLATE)
+    site_status = site['status']
+    if site['site_id'] in site_status_changes:
+      site_status = "%s (was %s)" % (
+        site_status_changes[site['site_id']]['now'],
+        site_status_changes[site['site_id']]['was'])
+    mailbody += s.substitute(siteName=site['site_name'], status=site_status,
+                             cpus=site['CPU'], memory=site['memory'],
+                             notes=notes)
+
+  getMailQueue().put('root@%s' % config.get("Server", "hostname"),
+                     userdata['email_address'],
+                     'Update: PRAGMA Cloud Scheduler reservation #%s' %
+                     reservation['reservation_id'],
+                     mailbody)
+
+
+def flush_mail(force=False):
+  """Send queued notification emails that are due
+
+    Args:
+      force(bool): send all queued emails now, ignoring the digest window
+  """
+  sent = getMailQueue().flush(
+    getConfigOption(config, "Mail", "smtpHost", "localhost"),
+    int(getConfigOption(config, "Mail", "digestSecs", 60)),
+    int(getConfigOption(config, "Mail", "retrySecs", 60)),
+    int(getConfigOption(config, "Mail", "maxRetrySecs", 3600)),
+    int(getConfigOption(config, "Mail", "maxAttempts", 10)),
+    force)
+  if sent:
+    logging.info("Sent %d notification email(s)" % sent)
+
+
+vc_state = None
+vc_state_lock = threading.Lock()
+
+
+def getIndex():
+  """Return the shared index of virtual cluster state, opening it if needed"""
+  global vc_state
+  with vc_state_lock:
+    if vc_state is None:
+      vc_state = vc_index.VCIndex(
+        getConfigOption(config, "Index", "file", vc_index.default_path))
+    return vc_state
+
+
+def callIndex(method, *args, **kwargs):
+  """Call method of the shared index with args, logging rather than raising
+  any error, so that an unavailable index never stops reservations being
+  handled"""
+  try:
+    return getattr(getIndex(), method)(*args, **kwargs)
+  except (IOError, OSError, sqlite3.Error) as e:
+    logging.error("Index of virtual clusters failed in %s: %s" % (method, e))
+    return None
+
+
+def getIndexPool():
+  """Return the pool name that reservations are indexed under"""
+  return getConfigOption(config, "Index", "pool", "pragma")
+
+
+def getRegistry():
+  """Open the vc-manager.py registry of pools and resources, or return None
+  if there is none"""
+  path = getConfigOption(
+    config, "Placement", "registry", vc_registry.default_path)
+  if not os.path.exists(path):
+    return None
+  return vc_registry.VCRegistry(path)
+
+
+mail = None
+mail_lock = threading.Lock()
+
+
+def getMailQueue():
+  """Return the shared queue of notification emails, opening it if needed"""
+  global mail
+  with mail_lock:
+    if mail is None:
+      mail = mail_queue.MailQueue(
+        getConfigOption(config, "Mail", "spool", mail_queue.default_path))
+    return mail
+
+
+def reset_shared_state():
+  """Drop the connections, caches and stores shared by all reservations, so
+  they are made again from the current config when next used"""
+  global vc_state, mail
+  with RemoteShell.shells_lock:
+    RemoteShell.shells = {}
+  for cls in [SSHProbe, ClusterList, ImageInventory]:
+    with cls.shared_lock:
+      cls.shared = None
+  with LaunchExecutor.host_locks_lock:
+    LaunchExecutor.host_locks = {}
+  # not closed, as the mail sender thread may still be using the old ones
+  with vc_state_lock:
+    vc_state = None
+  with mail_lock:
+    mail = None
+
+
+def node_memory(mem, num_cpus):
+  """Return the memory (MB) of each VM when mem GB is split evenly across a
+  frontend and num_cpus compute nodes"""
+  return 1024 * round(int(mem) / (int(num_cpus) + 1.0))
+
+
+def getConfigOption(config, section, option, default):
+  """Read an optional config value
+
+    Args:
+      config(ConfigParser): Config file input data
+      section(string): Config section name
+      option(string): Config option name
+      default: Value to return if option is not set
+
+    Returns:
+      string: option value or default
+  """
+  if config.has_option(section, option):
+    return config.get(section, option)
+  return default
+
+
+def writeStringToFile(file, aString):
+  """Write a string to file
+
+    Args:
+      file(string): Path to file containing string
+      aString(string): string to write to file
+
+    Returns:
+      bool: True if success otherwise false
+  """
+  f = open(file, 'w')
+  f.write(aString)
+  return f.close()
+
+def reservation_deadline(reservation, shutdown_secs, poll_secs,
+                         poll_running=True, lead_secs=0):
+  """Return when a reservation next needs to be handled
+
+    Args:
+      reservation(dict): reservation record from Booked
+      shutdown_secs(int): stop reservation when this many secs are left
+      poll_secs(int): secs until next poll of sites that are waiting, due to
+        start, starting, running or stopping
+      poll_running(bool): False if running sites need handling only at
+        their stop time
+      lead_secs(int): secs before its start to stage a reservation
+
+    Returns:
+      float: time in secs since epoch, or None if nothing left to do
+  """
+  now = time.time()
+  start = calendar.timegm(datetime.strptime(
+    reservation['begin'][:ISO_LENGTH], ISO_FORMAT).timetuple())
+  end = calendar.timegm(datetime.strptime(
+    reservation['end'][:ISO_LENGTH], ISO_FORMAT).timetuple())
+  deadlines = []
+  for site in reservation['sites']:
+    if site['status'] == 'waiting':
+      deadlines.append(now + poll_secs)
+    elif site['status'] == 'created':
+      # stage once the lead time begins, then boot at the start; a site
+      # still not started after that is retried every poll_secs
+      if now < start - lead_secs:
+        deadlines.append(start - lead_secs)
+      elif now < start:
+        deadlines.append(start)
+      else:
+        deadlines.append(now + poll_secs)
+    elif site['status'] in ('starting', 'stopping'):
+      deadlines.append(now + poll_secs)
+    elif site['status'] in ('running', 'cancel'):
+      if poll_running:
+        deadlines.append(min(end - shutdown_secs, now + poll_secs))
+      else:
+        deadlines.append(end - shutdown_secs)
+  if not deadlines:
+    return None
+  return max(now, min(deadlines))
+
+
+def select_reservations(reservations, store):
+  """Return the reservations that changed or have a deadline coming up
+
+    Args:
+      reservations(list): reservation records from Booked
+      store(StateStore): state recorded on previous sweeps
+
+    Returns:
+      list: reservations that need to be handled this sweep
+  """
+  window = int(getConfigOption(config, "Sync", "deadlineWindow", 600))
+  shutdown_secs = int(config.get("Stopping", "reservationSecsLeft"))
+  lead_secs = int(getConfigOption(config, "Staging", "leadSecs", 0))
+  selected = []
+  for reservation in reservations:
+    deadline = reservation_deadline(
+      reservation, shutdown_secs, 0, False, lead_secs)
+    if store.changed(reservation) or staging_due(reservation, lead_secs) or (
+        deadline is not None and deadline - time.time() <= window):
+      selected.append(reservation)
+  return selected
+
+
+def staging_due(reservation, lead_secs):
+  """Return True if a site of reservation is still created and its lead
+  time has begun, so it must be staged or started whatever its deadline"""
+  start = calendar.timegm(datetime.strptime(
+    reservation['begin'][:ISO_LENGTH], ISO_FORMAT).timetuple())
+  return time.time() >= start - lead_secs and any(
+    [site['status'] == 'created' for site in reservation['sites']])
+
+
+def read_config(filename):
+  config = ConfigParser()
+  config.read(filename)
+  return config
+
+
+def configure_logging(config):
+  """Set up (or replace) the rotating log file handler"""
+  logger = logging.getLogger()
+  for old_handler in logger.handlers[:]:
+    logger.removeHandler(old_handler)
+    old_handler.close()
+  logger.setLevel(config.get("Logging", "level"))
+  handler = TimedRotatingFileHandler(config.get("Logging", "file"), when="W0",
+                                     interval=1, backupCount=5)
+  handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(threadName)s - line %(lineno)d - %(message)s"))
+  logger.addHandler(handler)
+
+
+def run_sweep(client):
+  """Examine all reservations once and determine which require actions"""
+  logging.debug("Reading current and future reservations")
+  data = client.query("pccGetAllReservations.py", "POST", None)
+
+  reservations = data["result"]
+  store = None
+  if getConfigOption(config, "Sync", "incremental", "true") == "true":
+    try:
+      store = StateStore(
+        os.path.join(config.get("Server", "dagDir"), "state.db"))
+      reservations = select_reservations(reservations, store)
+    except (IOError, OSError, sqlite3.Error) as e:
+      # without the store every reservation is handled, as if it changed
+      logging.error("Unable to read reservation state store: %s" % e)
+      if store:
+        store.close()
+      store = None
+    logging.info("Skipping %d of %d unchanged reservations (%.0f%%)" % (
+      len(data["result"]) - len(reservations), len(data["result"]),
+      100.0 * (len(data["result"]) - len(reservations)) /
+      max(1, len(data["result"]))))
+
+  # Iterate thru unique reservations
+  pool = WorkerPool(int(getConfigOption(config, "Concurrency", "workers", 1)))
+  client.prefetch(reservations, pool)
+  SSHProbe.get().prefetch(reservations)
+  pool.map(lambda reservation: process_reservation(reservation, client),
+           reservations)
+
+  if store:
+    try:
+      for reservation in data["result"]:
+        store.record(reservation)
+    except sqlite3.Error as e:
+      logging.error("Unable to update reservation state store: %s" % e)
+    finally:
+      store.close()
+
+  logging.info("Booked API usage this sweep: %s" % client.pool.stats())
+  client.pool.reset_stats()
+  for image in callIndex("image_report") or []:
+    logging.info("Image %s: %d launches, %.0f%% warm" % (
+      image['image'], image['launches'], 100 * image['hit_rate']))
+
+
+class Daemon:
+  """Long-running scheduler that wakes only when reservations need handling
+
+  Keeps a priority queue of (deadline, reservation_id) built from each
+  reservation's begin time, end time minus reservationSecsLeft, and an
+  adaptive poll interval for sites that are waiting, due to start, starting
+  or running.  A reservation not yet handled is due right away; after that
+  its poll interval doubles (up to pollMaxSecs) each time a poll does not
+  change any site status and is reset when one does, so a site that can not
+  move on (e.g. a deferred or failed launch) is not retried in a busy loop.
+  """
+
+  def __init__(self, config_filename):
+    self.config_filename = config_filename
+    self.client = None
+    self.reservations = {}
+    self.events = []
+    self.due = {}
+    self.poll_secs = {}
+    self.next_refresh = 0
+    self.reload_requested = False
+    self.stop_requested = False
+    self.sender = None
+
+  def _on_sighup(self, signum, frame):
+    self.reload_requested = True
+
+  def _on_sigterm(self, signum, frame):
+    self.stop_requested = True
+
+  def reload(self):
+    """(Re)read config file and start a new authenticated session"""
+    global config
+    config = read_config(self.config_filename)
+    configure_logging(config)
+    logging.info("Loaded configuration from %s" % self.config_filename)
+    self.refresh_secs = int(
+      getConfigOption(config, "Daemon", "refreshSecs", 300))
+    self.poll_min = int(getConfigOption(config, "Daemon", "pollMinSecs", 30))
+    self.poll_max = int(getConfigOption(config, "Daemon", "pollMaxSecs", 300))
+    self.pool = WorkerPool(
+      int(getConfigOption(config, "Concurrency", "workers", 1)))
+    reset_shared_state()
+    if self.client:
+      self.client.close()
+    self.client = GUIClient(config)
+    self.client.authenticate()
+    self.next_refresh = 0
+
+  def schedule(self, reservation, pending=None):
+    """Queue reservation for its next deadline
+
+      Args:
+        reservation(dict): reservation record from Booked
+        pending(float): already queued deadline to keep if it is sooner
+    """
+    rid = reservation['reservation_id']
+    when = reservation_deadline(
+      reservation, int(config.get("Stopping", "reservationSecsLeft")),
+      self.poll_secs.get(rid, 0), True,
+      int(getConfigOption(config, "Staging", "leadSecs", 0)))
+    if when is not None and pending is not None:
+      when = min(when, pending)
+    if when is None:
+      self.due.pop(rid, None)
+      self.reservations.pop(rid, None)
+      return
+    self.reservations[rid] = reservation
+    self.due[rid] = when
+    heapq.heappush(self.events, (when, rid))
+
+  def refresh(self):
+    """Fetch all reservations and rebuild the deadline queue"""
+    logging.debug("Reading current and future reservations")
+    try:
+      data = self.client.query("pccGetAllReservations.py", "POST", None)
+    except GUIClientError:
+      logging.info("Query failed; re-authenticating to Cloud GUI")
+      self.client.authenticate()
+      data = self.client.query("pccGetAllReservations.py", "POST", None)
+    self.client.prefetch(data["result"], self.pool)
+    pending = self.due
+    (self.events, self.due, self.reservations) = ([], {}, {})
+    for reservation in data["result"]:
+      self.schedule(reservation, pending.get(reservation['reservation_id']))
+    self.next_refresh = time.time() + self.refresh_secs
+    logging.info("Tracking %d reservations; Booked API usage: %s" % (
+      len(self.reservations), self.client.pool.stats()))
+    self.client.pool.reset_stats()
+
+  def pop_due(self):
+    """Return reservations whose deadline has passed"""
+    now = time.time()
+    due = []
+    while self.events and self.events[0][0] <= now:
+      (when, rid) = heapq.heappop(self.events)
+      if self.due.get(rid) == when:
+        del self.due[rid]
+        due.append(self.reservations[rid])
+    return due
+
+  def handle(self, reservations):
+    SSHProbe.get().prefetch(reservations)
+    updated = self.pool.map(
+      lambda reservation: process_reservation(reservation, self.client),
+      reservations)
+    for (before, after) in zip(reservations, updated):
+      rid = before['reservation_id']
+      if after is None:
+        after = before
+      was = [site['status'] for site in before['sites']]
+      now = [site['status'] for site in after['sites']]
+      if was == now and rid in self.poll_secs:
+        self.poll_secs[rid] = min(self.poll_max, 2 * self.poll_secs[rid])
+      else:
+        self.poll_secs[rid] = self.poll_min
+      self.schedule(after)
+
+  def send_mail(self):
+    """Send queued notification emails until the scheduler stops"""
+    while not self.stop_requested:
+      try:
+        flush_mail()
+      except Exception:
+        logging.exception("Error sending notification emails")
+      time.sleep(int(getConfigOption(config, "Mail", "flushSecs", 30)))
+
+  def run(self):
+    signal.signal(signal.SIGHUP, self._on_sighup)
+    signal.signal(signal.SIGTERM, self._on_sigterm)
+    self.reload()
+    self.sender = threading.Thread(target=self.send_mail)
+    self.sender.daemon = True
+    self.sender.start()
+    while not self.stop_requested:
+      try:
+        if self.reload_requested:
+          self.reload_requested = False
+          self.reload()
+        if time.time() >= self.next_refresh:
+          self.refresh()
+        due = self.pop_due()
+        if due:
+          self.handle(due)
+      except Exception:
+        logging.exception("Error in scheduler loop")
+        self.next_refresh = time.time() + self.poll_min
+      wake = self.next_refresh
+      if self.events:
+        wake = min(wake, self.events[0][0])
+      # signals interrupt the sleep so reloads happen right away
+      time.sleep(max(0, min(wake - time.time(), self.refresh_secs)))
+    logging.info("Stopping scheduler")
+    self.client.close()
+
+
+def main(argv=None):
+  global config
+  if argv is None:
+    argv = sys.argv[1:]
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("-c", "--config", dest="config",
+                    default="cloud-scheduler.cfg",
+                    help="config file [default: %default]", metavar="FILE")
+  parser.add_option("-d", "--daemon", dest="daemon", action="store_true",
+                    default=False, help="run continuously as a scheduler")
+  parser.add_option("-m", "--flush-mail", dest="flush_mail",
+                    action="store_true", default=False,
+                    help="only send all queued notification emails")
+  (opts, args) = parser.parse_args(argv)
+
+  if opts.daemon:
+    Daemon(opts.config).run()
+    return 0
+
+  # read input arguments from property file
+  config = read_config(opts.config)
+  configure_logging(config)
+
+  if opts.flush_mail:
+    flush_mail(force=True)
+    return 0
+
+  client = GUIClient(config)
+  try:
+    client.authenticate()
+    run_sweep(client)
+  except GUIClientError as e:
+    sys.stderr.write("%s\n" % e)
+    return 1
+  finally:
+    client.close()
+  # only once every reservation has been handled, so a slow MTA can not
+  # delay them; emails still in their digest window go out on a later run
+  flush_mail()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+
+"""vc-manager-benchmark.py
+
+Times vc-manager.py start-up for the commands web/list.php runs on every page
+load and checks them against a wall-clock budget.  Exits non-zero if the
+median time of any command is over budget.
+
+Example:
+      $ vc-manager-benchmark.py
+      $ vc-manager-benchmark.py --runs 50 --budget 0.15
+"""
+
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+# commands to time and the budget for the median run of each (secs)
+COMMANDS = [["help"], ["list", "pool"]]
+BUDGET = 0.15
+
+def timeCommand(vc_manager, command, runs):
+  """Return the sorted wall-clock times of running vc-manager.py command"""
+  times = []
+  devnull = open(os.devnull, "w")
+  for i in range(runs):
+    start = time.time()
+    subprocess.call([sys.executable, vc_manager] + command, stdout=devnull,
+                    stderr=devnull)
+    times.append(time.time() - start)
+  devnull.close()
+  return sorted(times)
+
+def main(argv=None):
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("-r", "--runs", dest="runs", type="int", default=20,
+                    help="runs per command [default: %default]")
+  parser.add_option("-b", "--budget", dest="budget", type="float",
+                    default=BUDGET,
+                    help="max median secs per command [default: %default]")
+  (opts, args) = parser.parse_args(argv)
+  vc_manager = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "vc-manager.py")
+
+  over_budget = False
+  for command in COMMANDS:
+    times = timeCommand(vc_manager, command, opts.runs)
+    median = times[len(times) / 2]
+    status = "ok"
+    if median > opts.budget:
+      status = "OVER BUDGET"
+      over_budget = True
+    print "%-12s median %.3fs  min %.3fs  max %.3fs  (budget %.3fs) %s" % (
+      " ".join(command), median, times[0], times[-1], opts.budget, status)
+  return 1 if over_budget else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
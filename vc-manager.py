@@ -1,8 +1,13 @@
 #! /usr/bin/env python
     
+import os
 import sys
 
 version = '1.0'
+
+# config file shared with pcc-check-reservations.py, unless given with -c
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "cloud-scheduler.cfg")
     
 class VCManager:
   """
@@ -27,15 +32,24 @@ class VCManager:
     add resource {pool} {name} {file}
       Add a resource described in file to the named Condor pool.  May want to
       consider (3.2.9 Dynamic Deployment) as a way to easily add new resources.
+      The file has one "name = value" line for each of hostname, cores and
+      memory (MB).
 
     help
       Display help for vc-manager.py
 
+    list image
+      List the VC images staged at each host and, for each image, how many
+      launches found it already staged (the image cache hit rate) and the
+      mean secs pragma_boot took to prepare it when it was and was not.
+
     list pool
       List the Condor pools (will probably be just 1 for this prototype).
 
     list resource {pool}
-      List the resources in the specified pool.
+      List the resources in the specified pool and its free cores.  With -j,
+      prints only the pool's totals as JSON: its number of resources,
+      total_cores, used_cores, total_memory and used_memory.
 
     qchkpt {pool} {cluster} 
       Snapshot a running virtual cluster. 
@@ -44,17 +58,27 @@ class VCManager:
       Delete a cluster job
 
     qstat {pool} [cluster] 
-      List the clusters in the Condor pool (i.e., condor_status) and each
-      cluster's status (i.e., queued, starting, running, saved). 
+      List the clusters in the pool and each cluster's status (i.e., created,
+      starting, running, stopping, stopped), read from the index of virtual
+      cluster state that pcc-check-reservations.py keeps up to date.
 
     qsub {pool} {file} 
       Submit a cluster job to Condor as a DAG workflow.
         
     remove pool {name}
-      Delete the specified pool.
+      Delete the specified pool and its resources.
 
     remove resource {pool} {resource}
       Delete a resource from the specified pool.
+
+  Options:
+
+    -c {file}
+      Read the locations of the index and registry from this config file
+      rather than the cloud-scheduler.cfg installed with vc-manager.py.
+
+    -j
+      Print the output of list and qstat commands as JSON.
    """   
 
   def __init__(self, argv):
@@ -63,23 +87,33 @@ class VCManager:
     if len(argv) < 1:
       print self.__doc__
       sys.exit(0)
+
+    self.json = False
+    self.config_file = CONFIG_FILE
+    self.config = None
+    while argv and argv[0] in ("-c", "-j"):
+      if argv[0] == "-j":
+        self.json = True
+        argv = argv[1:]
+      elif len(argv) > 1:
+        self.config_file = argv[1]
+        argv = argv[2:]
+      else:
+        sys.stderr.write("Config file missing after -c\n")
+        sys.exit(1)
     
-    # Use python introspection to call appropriate function based on command.
-    # First looks for single command functions (e.g., command 'qstat' calls
-    # function 'qstat').   Then looks for double command functions (e.g.,
-    # command 'add pool' calls function 'addPool') and then triple commands
-    # (e.g., toBeAdded)
+    # Look up the function for the command in the command table.  First looks
+    # for single command functions (e.g., command 'qstat' calls function
+    # 'qstat').   Then looks for double command functions (e.g., command 'add
+    # pool' calls function 'addPool') and then triple commands (e.g.,
+    # toBeAdded).  Functions import any modules they need themselves so that
+    # startup stays fast for every command.
     for numwords in range(1,4):
       if numwords > len(argv): # don't continue if we run out of args to try
         break
-      # create a potential function name out of provided args
-      arg_function = argv[0];
-      for i in range(1, numwords):
-        arg_function = arg_function + argv[i].capitalize()
-      # look at functions in this class and look for a match
-      for function in dir(VCManager):
-        if arg_function == function:
-          sys.exit( getattr(self, function)(argv[numwords:]) )
+      function = COMMANDS.get(tuple(argv[:numwords]))
+      if function:
+        sys.exit( getattr(self, function)(argv[numwords:]) )
 
     # otherwise we error out
     sys.stderr.write("Unknown command '" + " ".join(argv) + "'.  ")
@@ -93,17 +127,180 @@ class VCManager:
       sys.stderr.write("Pool name missing\n");
       sys.stderr.write("Usage:  add pool {name} \n");
       sys.exit(1)
-      
+
+    self._registry("add_pool", argv[0])
     print "Created new pool " + argv[0]
 
+  def addResource(self, argv):
+    """Add a resource described in file to the named pool."""
+    if len(argv) < 3:
+      sys.stderr.write("Pool, resource name or file missing\n");
+      sys.stderr.write("Usage:  add resource {pool} {name} {file} \n");
+      sys.exit(1)
+
+    import vc_registry
+    try:
+      values = vc_registry.read_resource_file(argv[2])
+    except (IOError, vc_registry.RegistryError) as e:
+      sys.stderr.write("%s\n" % e)
+      sys.exit(1)
+    self._registry("add_resource", argv[0], argv[1], **values)
+    print "Added resource %s to pool %s" % (argv[1], argv[0])
+
   def help(self, argv):
     """Display help for vc-manager.py"""
 
     print self.__doc__
 
+  def listImage(self, argv):
+    """List the VC images staged at each host and image cache hit rates."""
+    import vc_index
+    (images, report) = ({}, [])
+    path = self._config("Index", "file", vc_index.default_path)
+    if os.path.exists(path):
+      index = vc_index.VCIndex(path)
+      (images, report) = (index.images(), index.image_report())
+      index.close()
+
+    if self.json:
+      import json
+      print json.dumps({"hosts": images, "images": report})
+      return
+    printTable(["hostname", "images"],
+               [{"hostname": host, "images": ",".join(images[host])}
+                for host in sorted(images)])
+    print
+    for image in report:
+      for key in ["hit_rate", "prepare_secs_warm", "prepare_secs_cold"]:
+        if image[key] is not None:
+          image[key] = "%.2f" % image[key]
+    printTable(["image", "launches", "hits", "hit_rate", "prepare_secs_warm",
+                "prepare_secs_cold"], report)
+
+  def listPool(self, argv):
+    """List the Condor pools."""
+    pools = self._registry("pools")
+    if self.json:
+      import json
+      print json.dumps(pools)
+      return
+    for pool in pools:
+      print pool["name"]
+
+  def listResource(self, argv):
+    """List the resources in the specified pool."""
+    if len(argv) <= 0:
+      sys.stderr.write("Pool name missing\n");
+      sys.stderr.write("Usage:  list resource {pool} \n");
+      sys.exit(1)
+
+    pool = self._registry("pool", argv[0])
+    if pool is None:
+      sys.stderr.write("Unknown pool %s\n" % argv[0])
+      sys.exit(1)
+    if self.json:
+      import json
+      print json.dumps(pool)
+      return
+    resources = self._registry("resources", argv[0])
+    columns = ["name", "hostname", "cores", "used_cores", "memory",
+               "used_memory"]
+    printTable(columns, resources)
+    print "%d of %d cores free" % (pool["total_cores"] - pool["used_cores"],
+                                   pool["total_cores"])
+
   def qstat(self, argv):
-    """List the clusters in the Condor pool."""
+    """List the clusters in the pool and their status."""
+    if len(argv) <= 0:
+      sys.stderr.write("Pool name missing\n");
+      sys.stderr.write("Usage:  qstat {pool} [cluster] \n");
+      sys.exit(1)
+
+    import vc_index
+    path = self._config("Index", "file", vc_index.default_path)
+    if not os.path.exists(path):
+      clusters = []
+    else:
+      index = vc_index.VCIndex(path)
+      clusters = index.query(pool=argv[0], cluster=(argv[1:] or [None])[0])
+      index.close()
+
+    if self.json:
+      import json
+      print json.dumps(clusters)
+      return
+    printTable(["cluster", "reservation_id", "site_id", "hostname", "status",
+                "public_ip", "ssh_delay"], clusters)
+
+  def removePool(self, argv):
+    """Delete the specified pool."""
+    if len(argv) <= 0:
+      sys.stderr.write("Pool name missing\n");
+      sys.stderr.write("Usage:  remove pool {name} \n");
+      sys.exit(1)
+
+    self._registry("remove_pool", argv[0])
+    print "Removed pool " + argv[0]
+
+  def removeResource(self, argv):
+    """Delete a resource from the specified pool."""
+    if len(argv) < 2:
+      sys.stderr.write("Pool or resource name missing\n");
+      sys.stderr.write("Usage:  remove resource {pool} {resource} \n");
+      sys.exit(1)
+
+    self._registry("remove_resource", argv[0], argv[1])
+    print "Removed resource %s from pool %s" % (argv[1], argv[0])
+
+  def _config(self, section, option, default):
+    """Return an option of the config file that pcc-check-reservations.py
+    reads too, or default if it is not set."""
+    if self.config is None:
+      from ConfigParser import ConfigParser
+      self.config = ConfigParser()
+      self.config.read(self.config_file)
+    if self.config.has_option(section, option):
+      return self.config.get(section, option)
+    return default
+
+  def _registry(self, method, *args, **kwargs):
+    """Call method of the pool and resource registry, exiting on errors."""
+    import vc_registry
+    registry = vc_registry.VCRegistry(
+      self._config("Placement", "registry", vc_registry.default_path))
+    try:
+      return getattr(registry, method)(*args, **kwargs)
+    except vc_registry.RegistryError as e:
+      sys.stderr.write("%s\n" % e)
+      sys.exit(1)
+    finally:
+      registry.close()
+
+def printTable(columns, rows):
+  """Print the columns of each dict in rows as an aligned table"""
+  rows = [columns] + [[str(row[column] if row[column] is not None else "-")
+                       for column in columns] for row in rows]
+  widths = [max([len(row[i]) for row in rows]) for i in range(len(columns))]
+  for row in rows:
+    print "  ".join([row[i].ljust(widths[i])
+                     for i in range(len(columns))]).rstrip()
+
+def commandTable(cls):
+  """Map each command's words to its function, e.g. ('add', 'pool') to
+  'addPool', by splitting the public function names of cls at capitals."""
+  table = {}
+  for function in cls.__dict__:
+    if function.startswith("_"):
+      continue
+    words = [""]
+    for c in function:
+      if c.isupper():
+        words.append(c.lower())
+      else:
+        words[-1] += c
+    table[tuple(words)] = function
+  return table
 
-    print "table indicating virtual cluster status"
+COMMANDS = commandTable(VCManager)
 
 VCManager(sys.argv[1:]) # trim off program name
@@ -0,0 +1,168 @@
+"""vc_index.py
+
+Indexed view of virtual cluster state shared by pcc-check-reservations.py,
+which updates it as it learns about each reservation site, and vc-manager.py,
+which answers qstat from it.
+
+Each row is one virtual cluster: the site of a reservation it was launched
+for, the frontend name pragma_boot gave it, its status and public IP.  Rows
+are updated in place as pcc-check-reservations.py reads Booked, pragma_boot.log
+and `pragma list cluster`, so the index never has to be rebuilt by scanning
+DAG directories, and lookups by pool, cluster or reservation use an index.
+
+The index also holds the VC images staged at each host and, for each launch,
+whether its image was already there (warm) and how long pragma_boot took to
+prepare it, from which image cache hit rates are reported.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+default_path = "/var/run/pcc/vc-index.db"
+
+# index columns in the order they are returned
+COLUMNS = ["pool", "cluster", "reservation_id", "site_id", "hostname",
+           "status", "public_ip", "ssh_delay", "updated"]
+
+
+class VCIndex:
+  def __init__(self, path=default_path):
+    self.path = path
+    self.lock = threading.Lock()
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS clusters (
+        pool TEXT NOT NULL,
+        cluster TEXT,
+        reservation_id TEXT NOT NULL,
+        site_id TEXT NOT NULL,
+        hostname TEXT,
+        status TEXT,
+        public_ip TEXT,
+        ssh_delay REAL,
+        updated REAL,
+        PRIMARY KEY (reservation_id, site_id));
+      CREATE INDEX IF NOT EXISTS clusters_pool ON clusters (pool, cluster);
+      CREATE TABLE IF NOT EXISTS images (
+        hostname TEXT NOT NULL,
+        image TEXT NOT NULL,
+        updated REAL,
+        PRIMARY KEY (hostname, image));
+      CREATE TABLE IF NOT EXISTS launches (
+        reservation_id TEXT NOT NULL,
+        site_id TEXT NOT NULL,
+        hostname TEXT,
+        image TEXT,
+        warm INTEGER,
+        launched REAL,
+        prepare_secs REAL,
+        PRIMARY KEY (reservation_id, site_id));
+      CREATE INDEX IF NOT EXISTS launches_image ON launches (image);
+    """)
+    # indexes created before ssh_delay was recorded
+    if "ssh_delay" not in [row[1] for row in
+                           self.db.execute("PRAGMA table_info(clusters)")]:
+      self.db.execute("ALTER TABLE clusters ADD COLUMN ssh_delay REAL")
+
+  def update(self, pool, reservation_id, site_id, **values):
+    """Create or update the cluster of a reservation site
+
+      Args:
+        pool(string): pool the cluster belongs to
+        reservation_id(string): Booked reservation ID
+        site_id(string): Booked site ID
+        values: new values of any of cluster, hostname, status, public_ip,
+          ssh_delay (secs from scheduled start to SSH being up); None
+          values are ignored
+    """
+    values = dict([(k, v) for (k, v) in values.items() if v is not None])
+    key = (str(reservation_id), str(site_id))
+    with self.lock:
+      with self.db:
+        self.db.execute(
+          "INSERT OR IGNORE INTO clusters (pool, reservation_id, site_id) "
+          "VALUES (?, ?, ?)", (pool,) + key)
+        values["pool"] = pool
+        values["updated"] = time.time()
+        self.db.execute(
+          "UPDATE clusters SET %s WHERE reservation_id = ? AND site_id = ?" %
+          ", ".join(["%s = ?" % column for column in values.keys()]),
+          tuple(values.values()) + key)
+
+  def query(self, pool=None, cluster=None, reservation_id=None):
+    """Return clusters as dicts, optionally only those matching the args"""
+    (clauses, args) = ([], [])
+    for (column, value) in [("pool", pool), ("cluster", cluster),
+                            ("reservation_id", reservation_id)]:
+      if value is not None:
+        clauses.append("%s = ?" % column)
+        args.append(str(value))
+    sql = "SELECT %s FROM clusters" % ", ".join(COLUMNS)
+    if clauses:
+      sql += " WHERE " + " AND ".join(clauses)
+    with self.lock:
+      rows = self.db.execute(
+        sql + " ORDER BY reservation_id, site_id", args).fetchall()
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+  def set_images(self, hostname, images):
+    """Replace the VC images recorded as staged at hostname"""
+    now = time.time()
+    with self.lock:
+      with self.db:
+        self.db.execute("DELETE FROM images WHERE hostname = ?", (hostname,))
+        self.db.executemany(
+          "INSERT INTO images (hostname, image, updated) VALUES (?, ?, ?)",
+          [(hostname, image, now) for image in set(images)])
+
+  def images(self):
+    """Return a dict of hostname to the sorted VC images staged there"""
+    with self.lock:
+      rows = self.db.execute(
+        "SELECT hostname, image FROM images ORDER BY hostname, image").fetchall()
+    images = {}
+    for (hostname, image) in rows:
+      images.setdefault(hostname, []).append(image)
+    return images
+
+  def record_launch(self, reservation_id, site_id, hostname, image, warm):
+    """Record that a reservation site was launched and whether its image
+    was already staged at the host"""
+    with self.lock:
+      with self.db:
+        self.db.execute(
+          "INSERT OR REPLACE INTO launches (reservation_id, site_id, hostname, "
+          "image, warm, launched) VALUES (?, ?, ?, ?, ?, ?)",
+          (str(reservation_id), str(site_id), hostname, image, int(warm),
+           time.time()))
+
+  def record_prepare(self, reservation_id, site_id, secs):
+    """Record how long pragma_boot took to prepare a launch's image"""
+    with self.lock:
+      with self.db:
+        self.db.execute(
+          "UPDATE launches SET prepare_secs = ? WHERE reservation_id = ? AND "
+          "site_id = ? AND prepare_secs IS NULL",
+          (secs, str(reservation_id), str(site_id)))
+
+  def image_report(self):
+    """Return per image launch counts, cache hits, hit rate and mean
+    preparation secs of warm and cold launches, as dicts"""
+    with self.lock:
+      rows = self.db.execute("""
+        SELECT image, COUNT(*), SUM(warm),
+          AVG(CASE WHEN warm THEN prepare_secs END),
+          AVG(CASE WHEN NOT warm THEN prepare_secs END)
+        FROM launches GROUP BY image ORDER BY image""").fetchall()
+    return [{"image": image, "launches": launches, "hits": hits,
+             "hit_rate": float(hits) / launches,
+             "prepare_secs_warm": warm, "prepare_secs_cold": cold}
+            for (image, launches, hits, warm, cold) in rows]
+
+  def close(self):
+    self.db.close()
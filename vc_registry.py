@@ -0,0 +1,251 @@
+"""vc_registry.py
+
+Registry of the pools vc-manager.py manages and the resources in each, kept
+in a SQLite database (WAL) so that concurrent vc-manager.py calls, e.g. from
+several web/list.php requests, can read and change it safely.
+
+Each resource records its host, cores and memory and how much of them is in
+use; pcc-check-reservations.py claims the cores and memory of each virtual
+cluster it launches on a resource and releases them once it is torn down.
+Triggers keep per-pool totals of these up to date whenever a resource is
+added, changed or removed, so the capacity of a pool is a single row lookup
+however many resources it has.
+
+A resource file, as given to `vc-manager.py add resource`, has one
+`name = value` per line; blank lines and lines starting with # are ignored:
+
+  hostname = rocks-101.sdsc.edu
+  cores = 32
+  memory = 65536
+"""
+
+import os
+import sqlite3
+import threading
+
+default_path = "/var/lib/pcc/vc-registry.db"
+
+# resource columns in the order they are returned
+RESOURCE_COLUMNS = ["pool", "name", "hostname", "cores", "memory",
+                    "used_cores", "used_memory"]
+
+# pool columns in the order they are returned
+POOL_COLUMNS = ["name", "resources", "total_cores", "used_cores",
+                "total_memory", "used_memory"]
+
+# accepted names of each field in a resource file
+RESOURCE_FIELDS = {"hostname": "hostname", "host": "hostname",
+                   "cores": "cores", "cpus": "cores",
+                   "memory": "memory"}
+
+
+class RegistryError(Exception):
+  pass
+
+
+class VCRegistry:
+  def __init__(self, path=default_path):
+    self.path = path
+    self.lock = threading.Lock()
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    # autocommit mode, so writes can take the write lock up front with
+    # BEGIN IMMEDIATE rather than failing to upgrade a read lock
+    self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                              check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS pools (
+        name TEXT PRIMARY KEY,
+        resources INTEGER NOT NULL DEFAULT 0,
+        total_cores INTEGER NOT NULL DEFAULT 0,
+        used_cores INTEGER NOT NULL DEFAULT 0,
+        total_memory INTEGER NOT NULL DEFAULT 0,
+        used_memory INTEGER NOT NULL DEFAULT 0);
+      CREATE TABLE IF NOT EXISTS resources (
+        pool TEXT NOT NULL REFERENCES pools (name),
+        name TEXT NOT NULL,
+        hostname TEXT,
+        cores INTEGER NOT NULL DEFAULT 0,
+        memory INTEGER NOT NULL DEFAULT 0,
+        used_cores INTEGER NOT NULL DEFAULT 0,
+        used_memory INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (pool, name),
+        CHECK (used_cores BETWEEN 0 AND cores),
+        CHECK (used_memory BETWEEN 0 AND memory));
+      CREATE INDEX IF NOT EXISTS resources_hostname ON resources (hostname);
+      CREATE TRIGGER IF NOT EXISTS resources_insert AFTER INSERT ON resources
+      BEGIN
+        UPDATE pools SET resources = resources + 1,
+          total_cores = total_cores + NEW.cores,
+          used_cores = used_cores + NEW.used_cores,
+          total_memory = total_memory + NEW.memory,
+          used_memory = used_memory + NEW.used_memory
+        WHERE name = NEW.pool;
+      END;
+      CREATE TRIGGER IF NOT EXISTS resources_delete AFTER DELETE ON resources
+      BEGIN
+        UPDATE pools SET resources = resources - 1,
+          total_cores = total_cores - OLD.cores,
+          used_cores = used_cores - OLD.used_cores,
+          total_memory = total_memory - OLD.memory,
+          used_memory = used_memory - OLD.used_memory
+        WHERE name = OLD.pool;
+      END;
+      CREATE TRIGGER IF NOT EXISTS resources_update AFTER UPDATE ON resources
+      BEGIN
+        UPDATE pools SET
+          total_cores = total_cores - OLD.cores + NEW.cores,
+          used_cores = used_cores - OLD.used_cores + NEW.used_cores,
+          total_memory = total_memory - OLD.memory + NEW.memory,
+          used_memory = used_memory - OLD.used_memory + NEW.used_memory
+        WHERE name = NEW.pool;
+      END;
+      CREATE TRIGGER IF NOT EXISTS pools_delete BEFORE DELETE ON pools
+      BEGIN
+        DELETE FROM resources WHERE pool = OLD.name;
+      END;
+    """)
+
+  def _write(self, func, *args):
+    """Run func(*args) in a transaction holding the database write lock"""
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        result = func(*args)
+      except:
+        self.db.execute("ROLLBACK")
+        raise
+      self.db.execute("COMMIT")
+      return result
+
+  def _pool_exists(self, pool):
+    return self.db.execute(
+      "SELECT 1 FROM pools WHERE name = ?", (pool,)).fetchone() is not None
+
+  def add_pool(self, pool):
+    """Create an empty pool; raises RegistryError if it already exists"""
+    def add():
+      if self._pool_exists(pool):
+        raise RegistryError("Pool %s already exists" % pool)
+      self.db.execute("INSERT INTO pools (name) VALUES (?)", (pool,))
+    self._write(add)
+
+  def remove_pool(self, pool):
+    """Remove a pool and all its resources"""
+    def remove():
+      if not self._pool_exists(pool):
+        raise RegistryError("Unknown pool %s" % pool)
+      self.db.execute("DELETE FROM pools WHERE name = ?", (pool,))
+    self._write(remove)
+
+  def add_resource(self, pool, name, hostname=None, cores=0, memory=0):
+    """Add a resource to a pool, or replace its description if it exists
+
+      Args:
+        pool(string): name of the pool
+        name(string): name of the resource
+        hostname(string): host of the resource
+        cores(int): number of cores of the resource
+        memory(int): memory of the resource (MB)
+    """
+    def add():
+      if not self._pool_exists(pool):
+        raise RegistryError("Unknown pool %s" % pool)
+      if self.db.execute(
+          "UPDATE resources SET hostname = ?, cores = ?, memory = ? "
+          "WHERE pool = ? AND name = ?",
+          (hostname, cores, memory, pool, name)).rowcount == 0:
+        self.db.execute(
+          "INSERT INTO resources (pool, name, hostname, cores, memory) "
+          "VALUES (?, ?, ?, ?, ?)", (pool, name, hostname, cores, memory))
+    try:
+      self._write(add)
+    except sqlite3.IntegrityError:
+      raise RegistryError("Resource %s has fewer cores or memory than are "
+                          "in use" % name)
+
+  def remove_resource(self, pool, name):
+    """Remove a resource from a pool"""
+    def remove():
+      if self.db.execute("DELETE FROM resources WHERE pool = ? AND name = ?",
+                         (pool, name)).rowcount == 0:
+        raise RegistryError("Unknown resource %s in pool %s" % (name, pool))
+    self._write(remove)
+
+  def use(self, pool, name, cores, memory=0):
+    """Add cores and memory to those in use on a resource; negative values
+    release them.  Raises RegistryError if more would be in use than the
+    resource has."""
+    def use():
+      if self.db.execute(
+          "UPDATE resources SET used_cores = used_cores + ?, "
+          "used_memory = used_memory + ? WHERE pool = ? AND name = ?",
+          (cores, memory, pool, name)).rowcount == 0:
+        raise RegistryError("Unknown resource %s in pool %s" % (name, pool))
+    try:
+      self._write(use)
+    except sqlite3.IntegrityError:
+      raise RegistryError("Not enough free capacity on resource %s" % name)
+
+  def pools(self):
+    """Return all pools and their capacity as dicts"""
+    with self.lock:
+      rows = self.db.execute("SELECT %s FROM pools ORDER BY name" %
+                             ", ".join(POOL_COLUMNS)).fetchall()
+    return [dict(zip(POOL_COLUMNS, row)) for row in rows]
+
+  def pool(self, pool):
+    """Return the capacity of a pool as a dict, or None if it is unknown"""
+    with self.lock:
+      row = self.db.execute("SELECT %s FROM pools WHERE name = ?" %
+                            ", ".join(POOL_COLUMNS), (pool,)).fetchone()
+    return row and dict(zip(POOL_COLUMNS, row))
+
+  def resources(self, pool):
+    """Return the resources of a pool as dicts"""
+    with self.lock:
+      rows = self.db.execute(
+        "SELECT %s FROM resources WHERE pool = ? ORDER BY name" %
+        ", ".join(RESOURCE_COLUMNS), (pool,)).fetchall()
+    return [dict(zip(RESOURCE_COLUMNS, row)) for row in rows]
+
+  def hosted(self, hostname):
+    """Return the resources of any pool on hostname as dicts"""
+    with self.lock:
+      rows = self.db.execute(
+        "SELECT %s FROM resources WHERE hostname = ? ORDER BY pool, name" %
+        ", ".join(RESOURCE_COLUMNS), (hostname,)).fetchall()
+    return [dict(zip(RESOURCE_COLUMNS, row)) for row in rows]
+
+  def close(self):
+    self.db.close()
+
+
+def read_resource_file(filename):
+  """Read a resource description file
+
+    Args:
+      filename(string): path to the resource file
+
+    Returns:
+      dict of hostname, cores and memory found in the file
+  """
+  values = {}
+  for line in open(filename):
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    if "=" not in line:
+      raise RegistryError("Bad line in %s: %s" % (filename, line))
+    (key, value) = [s.strip() for s in line.split("=", 1)]
+    field = RESOURCE_FIELDS.get(key.lower())
+    if field is None:
+      raise RegistryError("Unknown field %s in %s" % (key, filename))
+    if field in ("cores", "memory"):
+      try:
+        value = int(value)
+      except ValueError:
+        raise RegistryError("Bad value of %s in %s: %s" % (key, filename, value))
+    values[field] = value
+  return values